@@ -1,203 +1,1339 @@
-class Coloration(object):
-    """docstring for Coloration"""
-    def __init__(self, arg):
-        super(Coloration, self).__init__()
-        self.arg = arg
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Coloration.py
 
-        
-    def getFilenames(self, path2dir):
-        """Parse file names in directory"""
-        txt = glob.glob(os.path.join(path2dir, '*.txt'))
-        b = glob.glob(os.path.join(path2dir, '*.b'))
-        trans = glob.glob(os.path.join(path2dir, '*.transmission'))
-        filenames = trans + txt + b
-        return filenames
+The spectral processing engine behind spec.py: parsing, interpolation, smoothing,
+color measurments and plotting, plus the Coloration session class for running
+them in-process.
 
-    def smooth(self, x,window_len=11,window='hanning'):
-        """smooth the data using a window with requested size.
+Example:
 
-        This method is based on the convolution of a scaled window with the signal.
-        The signal is prepared by introducing reflected copies of the signal 
-        (with the window size) in both ends so that transient parts are minimized
-        in the begining and end part of the output signal.
+from Coloration import Coloration
+session = Coloration(min_nm=300, max_nm=700, header=True, smooth=True, window_length=25)
+spectra, header_list, errors = session.processFiles(session.getFilenames('test_data/testfiles_with_headers'))
+session.printColors(session.measure(spectra), header_list)
 
-        input:
-            x: the input signal 
-            window_len: the dimension of the smoothing window; should be an odd integer
-            window: the type of window from 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'
-                flat window will produce a moving average smoothing.
+"""
 
-        output:
-            the smoothed signal
+import os
+import sys
+import time
+import glob
+import json
+import contextlib
+import collections
+import itertools
+import numpy as np
 
-        example:
+# matplotlib AND scipy ARE IMPORTED INSIDE THE FUNCTIONS THAT USE THEM SO THAT
+# PLAIN CSV CONVERSIONS DO NOT PAY FOR LOADING THEM
 
-        t=linspace(-2,2,0.1)
-        x=sin(t)+randn(len(t))*0.1
-        y=smooth(x)
+def getFilenames(path2dir):
+    """Parse file names in directory"""
+    txt = glob.glob(os.path.join(path2dir, '*.txt'))
+    b = glob.glob(os.path.join(path2dir, '*.b'))
+    trans = glob.glob(os.path.join(path2dir, '*.transmission'))
+    filenames = trans + txt + b
+    return filenames
 
-        see also: 
+class StageTimer(object):
+    """ Wall time, call counts and item counts per pipeline stage. Items are spectra
+        except for parse, which counts rows of text. Stages run in worker processes are
+        summed over workers, so with -j they can add up to more than the wall time.
+        Does nothing until enable() is called.
+    """
+    def __init__(self):
+        super(StageTimer, self).__init__()
+        self.enabled = False
+        self.reset()
+    
+    def enable(self):
+        self.enabled = True
+        self.started = time.time()
+    
+    def reset(self):
+        self.stages = collections.OrderedDict()
+        self.started = time.time()
+    
+    def _entry(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'calls': 0, 'seconds': 0.0, 'items': 0}
+        return self.stages[name]
+    
+    @contextlib.contextmanager
+    def stage(self, name, items=0):
+        """Time the body of a with statement as one call of stage name"""
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            entry = self._entry(name)
+            entry['calls'] += 1
+            entry['seconds'] += time.time() - start
+            entry['items'] += items
+    
+    def count(self, name, items):
+        """Add items (files, rows parsed, ...) to stage name without timing anything"""
+        if self.enabled:
+            self._entry(name)['items'] += items
+    
+    def merge(self, stages):
+        """Add the stages of another StageTimer, e.g. one from a worker process"""
+        for name, other in stages.items():
+            entry = self._entry(name)
+            for field in ['calls', 'seconds', 'items']:
+                entry[field] += other[field]
+    
+    def results(self):
+        """Return the timings as a dict ready for json. Peak memory is None without resource (Windows)."""
+        own = children = None
+        try:
+            import resource
+        except ImportError:
+            resource = None
+        if resource != None:
+            if sys.platform == 'darwin': scale = 1.0 / 2**20 # BYTES ON MAC OS X, KB ELSEWHERE
+            else: scale = 1.0 / 2**10
+            own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+            children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+        return {'wall_seconds': time.time() - self.started,
+                'peak_memory_mb': own,
+                'peak_worker_memory_mb': children,
+                'stages': self.stages}
+    
+    def report(self, fout=sys.stderr):
+        """Print a summary table of the timings"""
+        results = self.results()
+        wall = results['wall_seconds']
+        fout.write('\n%-14s %8s %10s %7s %12s %14s\n' % ('stage', 'calls', 'seconds', '% wall', 'items', 'items/second'))
+        for name, entry in self.stages.items():
+            rate = ''
+            if entry['items'] and entry['seconds'] > 0: rate = '%.0f' % (entry['items'] / entry['seconds'])
+            fout.write('%-14s %8d %10.4f %7.1f %12d %14s\n' % (name, entry['calls'], entry['seconds'], \
+                       100 * entry['seconds'] / (wall or 1), entry['items'], rate))
+        fout.write('%-14s %8s %10.4f\n' % ('wall', '', wall))
+        if results['peak_memory_mb'] != None:
+            fout.write('peak memory %.1f MB (largest worker %.1f MB)\n' % \
+                       (results['peak_memory_mb'], results['peak_worker_memory_mb']))
 
-        numpy.hanning, numpy.hamming, numpy.bartlett, numpy.blackman, numpy.convolve
-        scipy.signal.lfilter
+# TIMINGS OF THIS PROCESS, TURNED ON BY -v OR --timing-json
+timer = StageTimer()
 
-        TODO: the window parameter could be the window itself if an array instead of a string   
-        """
+def smooth(x,window_len=11,window='hanning'):
+    """smooth the data using a window with requested size.
 
-        if x.ndim != 1:
-            raise ValueError, "smooth only accepts 1 dimension arrays."
+    This method is based on the convolution of a scaled window with the signal.
+    The signal is prepared by introducing reflected copies of the signal 
+    (with the window size) in both ends so that transient parts are minimized
+    in the begining and end part of the output signal.
 
-        if x.size < window_len:
-            raise ValueError, "Input vector needs to be bigger than window size."
+    input:
+        x: the input signal 
+        window_len: the dimension of the smoothing window; should be an odd integer
+        window: the type of window from 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'
+            flat window will produce a moving average smoothing.
 
-        if window_len<3:
-            return x
+    output:
+        the smoothed signal
 
-        if not window in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
-            raise ValueError, "Window is on of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'"
+    example:
+
+    t=linspace(-2,2,0.1)
+    x=sin(t)+randn(len(t))*0.1
+    y=smooth(x)
+
+    see also: 
+
+    np.hanning, np.hamming, np.bartlett, np.blackman, np.convolve
+    scipy.signal.lfilter
+
+    TODO: the window parameter could be the window itself if an array instead of a string   
+    """
+
+    if x.ndim != 1:
+        raise ValueError, "smooth only accepts 1 dimension arrays."
+
+    if x.size < window_len:
+        raise ValueError, "Input vector needs to be bigger than window size."
+
+    if window_len<3:
+        return x
 
-        s=numpy.r_[2*x[0]-x[window_len-1::-1],x,2*x[-1]-x[-1:-window_len:-1]]
+    if window not in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
+        raise ValueError, "Window is on of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'"
 
+    s=np.r_[2*x[0]-x[window_len-1::-1],x,2*x[-1]-x[-1:-window_len:-1]]
+
+    w=getWindow(window_len, window)
+    y=np.convolve(w,s,mode='same')
+    return y[window_len:-window_len+1]
+
+# NORMALIZED SMOOTHING KERNELS KEYED BY (window, window_len)
+_window_cache = {}
+
+# WINDOW LENGTH AT WHICH smoothArray SWITCHES FROM DIRECT TO FFT CONVOLUTION (SEE bench.py smooth)
+FFT_WINDOW_LENGTH = 15
+
+def getWindow(window_len, window='hanning'):
+    """Return the normalized smoothing kernel for window, building it only once per length"""
+    key = (window, window_len)
+    if key not in _window_cache:
         if window == 'flat': #moving average
-            w=numpy.ones(window_len,'d')
+            w=np.ones(window_len,'d')
         else:
-            w=eval('numpy.'+window+'(window_len)')
-
-        y=numpy.convolve(w/w.sum(),s,mode='same')
-        return y[window_len:-window_len+1]
-
-    def calcColorMeasurments(self, data_array):
-        """Print Liam's color measurments to SDOUT"""        
-        Macedonia_values = []
-        Endler_values = []
-        data_array = data_array.transpose()
-        for author in ['Macedonia', 'Endler']:
-            # CREATE SLICE INDICES
-            if author == 'Macedonia': Qt = (data_array[:,0] >= 325) & (data_array[:,0] <= 700)
-            else: Qt = (data_array[:,0] >= 400) & (data_array[:,0] <= 700)
-            U = (data_array[:,0] >= 325) & (data_array[:,0] < 400)
-            B = (data_array[:,0] >= 400) & (data_array[:,0] < 475)
-            G = (data_array[:,0] >= 475) & (data_array[:,0] < 550)
-            Y = (data_array[:,0] >= 550) & (data_array[:,0] < 625)
-            R = (data_array[:,0] >= 625) & (data_array[:,0] <= 700) 
-            
-            # DO BASIC CALCULATIONS
-            B = data_array[:,1:].compress(B,0).sum(0) / data_array[:,1:].compress(Qt,0).sum(0)
-            G = data_array[:,1:].compress(G,0).sum(0) / data_array[:,1:].compress(Qt,0).sum(0)
-            Y = data_array[:,1:].compress(Y,0).sum(0) / data_array[:,1:].compress(Qt,0).sum(0)
-            R = data_array[:,1:].compress(R,0).sum(0) / data_array[:,1:].compress(Qt,0).sum(0)
-            if author == 'Macedonia': U = data_array[:,1:].compress(U,0).sum(0) / data_array[:,1:].compress(Qt,0).sum(0)
-            else: U = numpy.zeros(data_array[:,1:].shape[-1])
-            Qt = data_array[:,1:].compress(Qt,0).sum(0)
-            
-            # CALCULATE MU, MS, LM, C, AND H
-            if author == 'Macedonia': MU = G-U
-            else: MU = numpy.zeros(data_array[:,1:].shape[-1])
-            MS = Y-B
-            LM = R-G
-            if author == 'Macedonia': C = numpy.sqrt(pow(LM,2)+pow(MS,2)+pow(MU,2))
-            else: C = numpy.sqrt(pow(LM,2)+pow(MS,2))
-            H = numpy.degrees(numpy.arccos(LM/C))
-            if author == 'Macedonia': 
-                Macedonia_values = [U,B,G,Y,R,Qt,MU,MS,LM,C,H]
-            else: 
-                Endler_values = [U,B,G,Y,R,Qt,MU,MS,LM,C,H]
-                
-        results = numpy.array([Macedonia_values, Endler_values])    
-        return results
-            
-    def printCSV(self, data_set, column_names, row_names):
-        """Print files as table"""
-        s = "Value,"+','.join(itertools.chain(column_names))
-        print s
-        for count, line in enumerate(data_set):
-            print row_names[count] + ',' + ','.join(["%.3f" % f for f in line])
+            w=getattr(np, window)(window_len)
+        _window_cache[key] = w/w.sum()
+    return _window_cache[key]
+
+def fastLength(n):
+    """Return the smallest length >= n with no prime factor above 5, which np.fft transforms quickly"""
+    best = 1
+    while best < n: best *= 2
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            length = p35
+            while length < n: length *= 2
+            best = min(best, length)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+def smoothArray(x,window_len=11,window='hanning',method='auto',kernel=None):
+    """smooth every row of a (samples x wavelengths) array in one pass.
+
+    Gives the same result as calling smooth() on each row. The rows are padded
+    with reflected copies as in smooth() and then convolved with the cached
+    window, either directly (one vectorized multiply-add per window tap) or
+    through an FFT along the wavelength axis.
+
+    input:
+        x: 2-D array with one spectrum per row (1-D arrays are treated as one row)
+        window_len: the dimension of the smoothing window
+        window: the type of window from 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'
+        method: 'direct', 'fft' or 'auto' (fft once window_len >= FFT_WINDOW_LENGTH)
+        kernel: a normalized window to use instead of looking one up with getWindow
+
+    output:
+        the smoothed array, same shape as x
+    """
+    x = np.asarray(x, dtype=float)
+    if x.ndim == 1:
+        return smoothArray(x[np.newaxis,:], window_len, window, method, kernel)[0]
+
+    if x.ndim != 2:
+        raise ValueError, "smoothArray only accepts 1 or 2 dimension arrays."
+
+    if x.shape[1] < window_len:
+        raise ValueError, "Input vector needs to be bigger than window size."
+
+    if window_len<3 or x.shape[0] == 0:
+        return x
+
+    if window not in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
+        raise ValueError, "Window is on of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'"
+
+    if method == 'auto':
+        if window_len >= FFT_WINDOW_LENGTH: method = 'fft'
+        else: method = 'direct'
+
+    # REFLECT-PAD EVERY ROW THE SAME WAY AS smooth()
+    s = np.hstack((2*x[:,:1]-x[:,window_len-1::-1], x, 2*x[:,-1:]-x[:,-1:-window_len:-1]))
+    if kernel is None: w = getWindow(window_len, window)
+    else: w = kernel
+    n = x.shape[1]
+    
+    # FULL CONVOLUTION INDEX OF THE FIRST OUTPUT VALUE ('same' MODE OFFSET PLUS PADDING)
+    first = (window_len-1)//2 + window_len
+
+    if method == 'direct':
+        y = np.zeros(x.shape)
+        for tap in range(window_len):
+            start = first - tap
+            y += w[tap] * s[:,start:start+n]
+        return y
+
+    elif method == 'fft':
+        # THE CIRCULAR WRAP ONLY REACHES THE FIRST window_len-1 VALUES, WHICH ARE DROPPED, SO THE
+        # TRANSFORM NEEDS TO COVER THE PADDED ROW BUT NOT THE FULL CONVOLUTION
+        nfft = fastLength(s.shape[1])
+        y = np.fft.irfft(np.fft.rfft(s, nfft, axis=1) * np.fft.rfft(w, nfft), nfft, axis=1)
+        return y[:,first:first+n]
+
+    else:
+        raise ValueError, "Method is one of 'auto', 'direct', 'fft'"
+
+# COLOR SCHEMES AS READ BY loadSchemes. EACH SCHEME NAMES ITS BANDS AS [NAME, LOWER NM, UPPER NM]
+# (ADD true TO INCLUDE THE UPPER EDGE), THE BANDS SUMMED INTO ITS TOTAL, ITS CONTRASTS AS
+# [NAME, BAND, BAND SUBTRACTED] OF BAND/TOTAL RATIOS, THE CONTRAST THAT SETS THE HUE ANGLE AND
+# THE ROWS IT REPORTS AS [LABEL, SOURCE]. A SOURCE IS A BAND (ITS RATIO), A CONTRAST, 'total',
+# 'chroma' (LENGTH OF THE CONTRAST VECTOR), 'hue' (DEGREES) OR null FOR A ROW OF ZEROS.
+DEFAULT_SCHEMES = [
+    {'name': 'Macedonia',
+     'bands': [['U', 325, 400], ['B', 400, 475], ['G', 475, 550], ['Y', 550, 625], ['R', 625, 700, True]],
+     'total': ['U', 'B', 'G', 'Y', 'R'],
+     'contrasts': [['LM', 'R', 'G'], ['MS', 'Y', 'B'], ['MU', 'G', 'U']],
+     'hue': 'LM',
+     'rows': [['U (325-399nm)', 'U'], ['B (40-474nm)', 'B'], ['G (475-549nm)', 'G'], ['Y (550-624)', 'Y'],
+              ['R (625-700)', 'R'], ['Qt', 'total'], ['MU', 'MU'], ['MS', 'MS'], ['LM', 'LM'],
+              ['C', 'chroma'], ['H', 'hue']]},
+    {'name': 'Endler',
+     'bands': [['B', 400, 475], ['G', 475, 550], ['Y', 550, 625], ['R', 625, 700, True]],
+     'total': ['B', 'G', 'Y', 'R'],
+     'contrasts': [['LM', 'R', 'G'], ['MS', 'Y', 'B']],
+     'hue': 'LM',
+     'rows': [['U (325-399nm)', None], ['B (40-474nm)', 'B'], ['G (475-549nm)', 'G'], ['Y (550-624)', 'Y'],
+              ['R (625-700)', 'R'], ['Qt', 'total'], ['MU', None], ['MS', 'MS'], ['LM', 'LM'],
+              ['C', 'chroma'], ['H', 'hue']]}]
+
+def checkScheme(scheme):
+    """Validate a color scheme and return it with the optional total and rows filled in"""
+    try:
+        name = scheme['name']
+        bands = [[str(band[0]), float(band[1]), float(band[2]), len(band) > 3 and bool(band[3])] for band in scheme['bands']]
+        contrasts = [[str(c) for c in contrast] for contrast in scheme.get('contrasts', [])]
+    except (KeyError, IndexError, TypeError, ValueError), e:
+        raise ValueError, "Color scheme %s is malformed (%s: %s)" % (scheme.get('name'), e.__class__.__name__, e)
+    if len(bands) == 0: raise ValueError, "Color scheme %s has no bands" % (name)
+    band_names = [band[0] for band in bands]
+    contrast_names = [contrast[0] for contrast in contrasts]
+    total = scheme.get('total', band_names)
+    hue = scheme.get('hue')
+    rows = scheme.get('rows')
+    if rows == None:
+        rows = [[n, n] for n in band_names] + [['Qt', 'total']] + [[n, n] for n in contrast_names]
+        if len(contrasts) > 0: rows += [['C', 'chroma']]
+        if hue != None: rows += [['H', 'hue']]
+    
+    # EVERY NAME MUST POINT AT SOMETHING THE SCHEME DEFINES
+    if len(total) == 0: raise ValueError, "Color scheme %s totals no bands" % (name)
+    for band in total:
+        if band not in band_names: raise ValueError, "Color scheme %s totals unknown band %s" % (name, band)
+    for contrast in contrasts:
+        if len(contrast) != 3 or contrast[1] not in band_names or contrast[2] not in band_names:
+            raise ValueError, "Color scheme %s contrast %s is not [name, band, band]" % (name, contrast)
+    if hue != None and hue not in contrast_names:
+        raise ValueError, "Color scheme %s hue %s is not one of its contrasts" % (name, hue)
+    for label, source in rows:
+        if source not in band_names + contrast_names + ['total', 'chroma', 'hue', None]:
+            raise ValueError, "Color scheme %s row %s has unknown source %s" % (name, label, source)
+        if source == 'hue' and hue == None:
+            raise ValueError, "Color scheme %s reports a hue but does not name its hue contrast" % (name)
+    return {'name': name, 'bands': bands, 'total': list(total), 'contrasts': contrasts, 'hue': hue,
+            'rows': [[str(label), source] for label, source in rows]}
+
+def loadSchemes(filename):
+    """Read a JSON list of color schemes (see DEFAULT_SCHEMES) from filename"""
+    fin = open(filename,'r')
+    try: schemes = json.load(fin)
+    except ValueError, e: raise ValueError, "%s is not valid JSON (%s)" % (filename, e)
+    fin.close()
+    if isinstance(schemes, dict): schemes = [schemes]
+    return [checkScheme(scheme) for scheme in schemes]
+
+# COMPILED SCHEMES KEYED BY (WAVELENGTH GRID, SCHEMES)
+_scheme_cache = {}
+
+def compileSchemes(nanometers, schemes=DEFAULT_SCHEMES):
+    """ Compile color schemes for one wavelength grid. Every distinct band of every scheme
+        becomes one row of a (bands x wavelengths) 0/1 weight matrix, so a single matrix
+        product gives all band sums of all schemes; each scheme keeps the indices it needs
+        to turn those sums into its rows.
+    """
+    nanometers = np.asarray(nanometers, dtype=float)
+    schemes = [checkScheme(scheme) for scheme in schemes]
+    key = (nanometers.tostring(), json.dumps(schemes, sort_keys=True))
+    if key in _scheme_cache:
+        return _scheme_cache[key]
+    
+    edges = []
+    compiled_schemes = []
+    for scheme in schemes:
+        # BANDS SHARED BETWEEN SCHEMES ARE SUMMED ONCE
+        bands = []
+        for name, lower, upper, closed in scheme['bands']:
+            if (lower, upper, closed) not in edges: edges.append((lower, upper, closed))
+            bands.append(edges.index((lower, upper, closed)))
+        band_names = [band[0] for band in scheme['bands']]
+        contrast_names = [contrast[0] for contrast in scheme['contrasts']]
+        rows = []
+        for label, source in scheme['rows']:
+            if source in band_names: rows.append((label, 'ratio', band_names.index(source)))
+            elif source in contrast_names: rows.append((label, 'contrast', contrast_names.index(source)))
+            else: rows.append((label, source, None))
+        hue = None
+        if scheme['hue'] != None: hue = contrast_names.index(scheme['hue'])
+        compiled_schemes.append({'name': scheme['name'], 'bands': np.array(bands, dtype=int),
+            'total': [band_names.index(band) for band in scheme['total']],
+            'plus': np.array([band_names.index(c[1]) for c in scheme['contrasts']], dtype=int),
+            'minus': np.array([band_names.index(c[2]) for c in scheme['contrasts']], dtype=int),
+            'hue': hue, 'rows': rows})
+    
+    weights = np.zeros((len(edges), nanometers.size))
+    for count, (lower, upper, closed) in enumerate(edges):
+        if closed: inside = (nanometers >= lower) & (nanometers <= upper)
+        else: inside = (nanometers >= lower) & (nanometers < upper)
+        weights[count, inside] = 1.0
+    
+    compiled = {'nanometers': nanometers, 'weights': weights, 'schemes': compiled_schemes}
+    if len(_scheme_cache) >= 16: _scheme_cache.clear()
+    _scheme_cache[key] = compiled
+    return compiled
+
+def schemeMeasurments(data_array, schemes=DEFAULT_SCHEMES, compiled=None):
+    """ Measure every spectrum in data_array (a SpectrumSet or an array with the nanometers in
+        the first row) with every color
+        scheme. Returns the rows of all schemes stacked in one (rows x samples) array; see
+        splitColors for the table of each scheme.
+    """
+    nanometers, reflectances = spectrumArrays(data_array)
+    if compiled == None: compiled = compileSchemes(nanometers, schemes)
+    
+    # ONE MATRIX PRODUCT FOR THE BAND SUMS OF EVERY SCHEME AND SAMPLE
+    sums = np.dot(compiled['weights'], np.transpose(reflectances))
+    
+    results = []
+    for scheme in compiled['schemes']:
+        band_sums = sums[scheme['bands']]
+        total = band_sums[scheme['total'][0]]
+        for band in scheme['total'][1:]:
+            total = total + band_sums[band]
+        ratios = band_sums / total
+        contrasts = ratios[scheme['plus']] - ratios[scheme['minus']]
+        chroma = np.zeros(total.shape)
+        for contrast in contrasts:
+            chroma = chroma + pow(contrast,2)
+        chroma = np.sqrt(chroma)
+        if scheme['hue'] != None:
+            hue = np.degrees(np.arccos(contrasts[scheme['hue']]/chroma))
         
-        # data_set = numpy.transpose(data_set)
-        # numpy.savetxt(fout, data_set, delimiter=',', fmt='%1.4f')   # X is an array
+        sources = {'total': total, 'chroma': chroma, None: np.zeros(total.shape)}
+        for label, source, index in scheme['rows']:
+            if source == 'ratio': results.append(ratios[index])
+            elif source == 'contrast': results.append(contrasts[index])
+            elif source == 'hue': results.append(hue)
+            else: results.append(sources[source])
+    return np.array(results).reshape(len(results), sums.shape[1])
 
-    def saveCSV(self, data_set, column_names, fout):
-        """Save files as table"""
-        fout = open(fout,'w')
-        s = 'nanometers,' + ','.join(itertools.chain(column_names)) + '\n'
-        fout.write(s)
-        data_set = numpy.transpose(data_set)
-        numpy.savetxt(fout, data_set, delimiter=',', fmt='%1.4f')   # X is an array
+def splitColors(colors, schemes=DEFAULT_SCHEMES):
+    """Split stacked schemeMeasurments rows into a (name, row labels, table) per scheme"""
+    colors = np.asarray(colors)
+    # THE ROW COUNT IS GIVEN SO A SET WITH NO SAMPLES STILL SPLITS
+    colors = colors.reshape(int(np.prod(colors.shape[:-1])), colors.shape[-1])
+    tables = []
+    start = 0
+    for scheme in [checkScheme(scheme) for scheme in schemes]:
+        labels = [label for label, source in scheme['rows']]
+        tables.append((scheme['name'], labels, colors[start:start+len(labels)]))
+        start += len(labels)
+    return tables
 
+def calcColorMeasurments(data_array):
+    """Print Liam's color measurments to SDOUT"""        
+    # THE MACEDONIA AND ENDLER TABLES AS ONE (2 x 11 x samples) ARRAY
+    return np.array([table for name, labels, table in splitColors(schemeMeasurments(data_array))])
         
-    def parseFile(self, filename, min_reflct, max_reflct, header, intrp):
-        """ Read in ocean optics datafile (with headers) and return array of reflectance measurments
-            The user can provide min and max reflectance values (e.g., 300-700)
+def printCSV(data_set, column_names, row_names, fout=sys.stdout):
+    """Print files as table"""
+    
+    s = "Value,"+','.join(itertools.chain(column_names))
+    fout.write(s + '\n')
+    for count, line in enumerate(data_set):
+        fout.write(row_names[count] + ',' + ','.join(["%.3f" % f for f in line]) + '\n')
+    
+    # data_set = np.transpose(data_set)
+    # np.savetxt(fout, data_set, delimiter=',', fmt='%1.4f')   # X is an array
+
+def printColors(colors, column_names, fout=sys.stdout, schemes=DEFAULT_SCHEMES):
+    """Print the table of each color scheme from schemeMeasurments or calcColorMeasurments"""
+    for count, (name, labels, table) in enumerate(splitColors(colors, schemes)):
+        if count > 0: fout.write('\n')
+        fout.write('%s Values\n' % (name))
+        printCSV(table, column_names, labels, fout)
+
+def saveCSV(data_set, column_names, fout):
+    """Save files as table"""
+    fout = open(fout,'w')
+    s = 'nanometers,' + ','.join(itertools.chain(column_names)) + '\n'
+    fout.write(s)
+    nanometers, reflectances = spectrumArrays(data_set)
+    data_set = np.column_stack((nanometers, np.transpose(reflectances)))
+    np.savetxt(fout, data_set, delimiter=',', fmt='%1.4f')   # X is an array
+
+def parseDataBlock(text, min_reflct, max_reflct):
+    """ Convert a block of whitespace separated nanometer/reflectance rows with a single bulk
+        numpy call and return the columns falling inside the min_reflct-max_reflct window.
+    """
+    first_line = text[:text.find('\n')] if '\n' in text else text
+    numb_cols = len(first_line.split())
+    if numb_cols == 0:
+        return (np.array([]), np.array([]))
+    values = np.fromstring(text, dtype=float, sep=' ').reshape(-1, numb_cols)
+    timer.count('parse', values.shape[0]) # ROWS, SO PARSE REPORTS ROWS/SECOND
+    return windowSpectrum(values[:,0], values[:,1], min_reflct, max_reflct)
+
+def windowSpectrum(nanometers, reflectances, min_reflct, max_reflct):
+    """Return copies of the (nanometers, reflectances) falling inside the min_reflct-max_reflct window"""
+    # KEEP ROWS FROM min_reflct UP TO AND INCLUDING THE FIRST ROW PAST max_reflct
+    lower = np.searchsorted(nanometers, min_reflct, side='left')
+    upper = np.searchsorted(nanometers, max_reflct, side='right') + 1
+    return (np.array(nanometers[lower:upper]), np.array(reflectances[lower:upper]))
+
+def parseSpectralText(text, min_reflct, max_reflct, header):
+    """ Parse the text of an ocean optics datafile and return the nanometer and reflectance
+        columns falling inside the min_reflct-max_reflct window. The data block is located
+        once and converted with a single bulk numpy call rather than line by line.
+    """
+    # FIND THE SPECTRAL DATA BLOCK
+    if header == True:
+        begin = text.find('Begin')
+        end = text.find('End')
+        if begin == -1 or (end != -1 and end < begin):
+            return (np.array([]), np.array([]))
+        start = text.find('\n', begin) + 1
+        if start == 0 or (end != -1 and end < start):
+            return (np.array([]), np.array([]))
+        end = text.find('End', start)
+        if end == -1: stop = len(text)
+        else: stop = text.rfind('\n', start, end) + 1
+        text = text[start:stop]
+    
+    # CONVERT THE WHOLE BLOCK AT ONCE
+    return parseDataBlock(text, min_reflct, max_reflct)
+
+# FILE READERS AS NAME -> (SNIFF, READ, HEADER FIELDS), TRIED IN ORDER BY sniffFormat. sniff(head)
+# GETS THE FIRST SNIFF_BYTES OF A FILE; read(text, min_reflct, max_reflct) RETURNS
+# (nanometers, reflectances, metadata)
+READERS = collections.OrderedDict()
+
+# BYTES OF A FILE LOOKED AT TO DECIDE ITS FORMAT
+SNIFF_BYTES = 512
+
+# BYTES OF A FILE READ BY readMetadata, ENOUGH FOR ANY OCEAN OPTICS HEADER
+HEADER_BYTES = 4096
+
+# METADATA KEYS FILLED IN BY THE READERS
+METADATA_FIELDS = ['format', 'integration_time_us', 'spectra_averaged', 'boxcar', 'serial',
+                   'dark_present', 'reference_present']
+
+def registerReader(name, sniff, read, fields=()):
+    """ Add a file format to READERS. fields lists the (metadata key, header label, conversion)
+        that parseMetadata pulls out of the header of this format.
+    """
+    READERS[name] = (sniff, read, fields)
+
+def sniffFormat(head):
+    """Return the name of the first registered format whose sniff accepts head, or None"""
+    head = head[:SNIFF_BYTES]
+    for name, (sniff, read, fields) in READERS.items():
+        if sniff(head): return name
+    return None
+
+def parseMetadata(header_text, name):
+    """Pull the header fields of format name out of the 'Label: value' lines of header_text"""
+    metadata = {'format': name}
+    labels = {}
+    for line in header_text.splitlines():
+        label, colon, value = line.partition(':')
+        if colon: labels[label.strip()] = value.strip()
+    for key, label, convert in READERS[name][2]:
+        if label not in labels: continue
+        try: metadata[key] = convert(labels[label].split()[0])
+        except (ValueError, IndexError): pass
+    return metadata
+
+def readBeginEnd(text, min_reflct, max_reflct, name):
+    """ Read an Ocean Optics file with a 'Label: value' header followed by a data block between
+        >>>>>Begin ...<<<<< and >>>>>End ...<<<<< lines. Header and data come from one pass.
+    """
+    begin = text.find('>>>>>Begin')
+    if begin == -1:
+        return (np.array([]), np.array([]), parseMetadata(text, name))
+    start = text.find('\n', begin) + 1
+    end = text.find('>>>>>End', start)
+    if start == 0: stop = start = len(text)
+    elif end == -1: stop = len(text)
+    else: stop = text.rfind('\n', start, end) + 1
+    nanometers, reflectances = parseDataBlock(text[start:stop], min_reflct, max_reflct)
+    return (nanometers, reflectances, parseMetadata(text[:begin], name))
+
+def readSpectraSuite(text, min_reflct, max_reflct):
+    """Reader for SpectraSuite Data Files"""
+    return readBeginEnd(text, min_reflct, max_reflct, 'spectrasuite')
+
+def readOOIBase32(text, min_reflct, max_reflct):
+    """Reader for OOIBase32 Data Files"""
+    return readBeginEnd(text, min_reflct, max_reflct, 'ooibase32')
+
+def readHeaderless(text, min_reflct, max_reflct):
+    """Reader for bare nanometer/reflectance columns"""
+    nanometers, reflectances = parseDataBlock(text, min_reflct, max_reflct)
+    return (nanometers, reflectances, {'format': 'headerless'})
+
+def sniffHeaderless(head):
+    """True if the first line of head is all numbers"""
+    fields = head.lstrip().split('\n', 1)[0].split()
+    try: [float(value) for value in fields]
+    except ValueError: return False
+    return len(fields) >= 2
+
+registerReader('spectrasuite', lambda head: head.startswith('SpectraSuite'), readSpectraSuite,
+               [('integration_time_us', 'Integration Time (usec)', float),
+                ('spectra_averaged', 'Spectra Averaged', int),
+                ('boxcar', 'Boxcar Smoothing', int),
+                ('serial', 'Spectrometers', str),
+                ('dark_present', 'Dark Spectrum Present', lambda value: value == 'Yes'),
+                ('reference_present', 'Reference Spectrum Present', lambda value: value == 'Yes')])
+registerReader('ooibase32', lambda head: head.startswith('OOIBase32'), readOOIBase32,
+               [('integration_time_us', 'Integration Time (msec)', lambda value: float(value) * 1000),
+                ('spectra_averaged', 'Spectra Averaged', int),
+                ('boxcar', 'Boxcar Smoothing', int),
+                ('serial', 'Spectrometer Serial Number', str)])
+registerReader('headerless', sniffHeaderless, readHeaderless)
+
+def parseSpectrum(text, min_reflct, max_reflct, header=False, format='auto'):
+    """ Parse the text of a datafile with the reader of its format and return (nanometers,
+        reflectances, metadata) inside the min_reflct-max_reflct window. With format 'auto'
+        the format is sniffed from the start of the text; text no reader recognizes is parsed
+        by parseSpectralText according to header.
+    """
+    if format == 'auto':
+        format = sniffFormat(text)
+    if format == None:
+        nanometers, reflectances = parseSpectralText(text, min_reflct, max_reflct, header)
+        return (nanometers, reflectances, {'format': None})
+    return READERS[format][1](text, min_reflct, max_reflct)
+
+def loadSpectrum(filename, min_reflct, max_reflct, header=False, format='auto'):
+    """ Read in ocean optics datafile and return the raw (nanometers, reflectances, metadata)
+        inside the min_reflct-max_reflct window (e.g., 300-700) without interpolating.
+    """
+    min_reflct = float(min_reflct)
+    max_reflct = float(max_reflct) + 1.0
+    fin = open(filename,'r')
+    text = fin.read()
+    fin.close()
+    return parseSpectrum(text, min_reflct, max_reflct, header, format)
+
+def readSpectrum(filename, min_reflct, max_reflct, header, format='auto'):
+    """ Read in ocean optics datafile and return the raw (nanometers, reflectances) arrays
+        inside the min_reflct-max_reflct window (e.g., 300-700) without interpolating.
+    """
+    return loadSpectrum(filename, min_reflct, max_reflct, header, format)[:2]
+
+def readMetadata(filename, format='auto'):
+    """Return the metadata of a file from its header alone, without parsing the data"""
+    fin = open(filename,'r')
+    head = fin.read(HEADER_BYTES)
+    fin.close()
+    if format == 'auto':
+        format = sniffFormat(head)
+    if format == None:
+        return {'format': None}
+    begin = head.find('>>>>>Begin')
+    if begin != -1: head = head[:begin]
+    return parseMetadata(head, format)
+
+def interpolateSpectrum(nanometers, reflectances, min_reflct, max_reflct, intrp):
+    """ Fit a spline to one raw spectrum and return (reflectances, nanometers) evaluated
+        every intrp nm from min_reflct to max_reflct.
+    """
+    from scipy import interpolate
+    min_reflct = float(min_reflct)
+    max_reflct = float(max_reflct) + 1.0
+    tck = interpolate.splrep(nanometers,reflectances,xb=min_reflct,s=0)
+    nanometers = np.arange(min_reflct,max_reflct,intrp)
+    reflectances = interpolate.splev(nanometers,tck,der=0)
+    return (np.array(reflectances), np.array(nanometers))
+
+def parseFile(filename, min_reflct, max_reflct, header, intrp, format='auto'):
+    """ Read in ocean optics datafile (with headers) and return array of reflectance measurments
+        The user can provide min and max reflectance values (e.g., 300-700)
+    """
+    nanometers, reflectances = readSpectrum(filename, min_reflct, max_reflct, header, format)
+    basename = os.path.basename(filename)
+    
+    # INTERPOLATE VALUES TO 1 NM INCREMENTS
+    reflectances, nanometers = interpolateSpectrum(nanometers, reflectances, min_reflct, max_reflct, intrp)
+    return (reflectances, nanometers, basename)
+
+# RESAMPLING OPERATORS KEYED BY (SOURCE GRID, min_reflct, max_reflct, intrp)
+_operator_cache = {}
+
+# SMALLEST NUMBER OF FILES ON ONE GRID WORTH RESAMPLING WITH A SHARED OPERATOR
+SHARED_GRID_MIN_FILES = 2
+
+def splineBasis(knots, points, order=3):
+    """ Evaluate the B-spline basis on knots at every point with de Boor's recursion (as FITPACK's
+        fpbspl does, extrapolating past the end intervals). Returns (first, values) where
+        values[p,i] is basis function first[p]+i at points[p].
+    """
+    # INTERVAL knots[l] <= point < knots[l+1], CLAMPED TO THE BASE INTERVAL LIKE splev
+    interval = np.searchsorted(knots, points, side='right') - 1
+    interval = np.clip(interval, order, len(knots) - order - 2)
+    values = np.zeros((points.size, order + 1))
+    values[:,0] = 1.0
+    for j in range(1, order + 1):
+        previous = values[:,:j].copy()
+        values[:,0] = 0.0
+        for i in range(1, j + 1):
+            right = knots[interval + i]
+            left = knots[interval + i - j]
+            f = previous[:,i-1] / (right - left)
+            values[:,i-1] += f * (right - points)
+            values[:,i] = f * (points - left)
+    return (interval - order, values)
+
+def resampleOperator(nanometers, min_reflct, max_reflct, intrp):
+    """ Return the cached operator that maps reflectances sampled at nanometers onto the intrp
+        grid exactly as interpolateSpectrum does. An interpolating spline (s=0) is linear in
+        the data and its knots depend only on the source grid, so the operator is a banded
+        collocation matrix to solve plus the sparse basis of the target grid. Use it with
+        resampleStack.
+    """
+    key = (nanometers.tostring(), min_reflct, max_reflct, intrp)
+    if key in _operator_cache:
+        return _operator_cache[key]
+    
+    from scipy import interpolate
+    min_reflct = float(min_reflct)
+    max_reflct = float(max_reflct) + 1.0
+    target = np.arange(min_reflct,max_reflct,intrp)
+    order = 3
+    knots = interpolate.splrep(nanometers,nanometers,xb=min_reflct,s=0)[0]
+    
+    # BANDED COLLOCATION MATRIX OF THE SOURCE GRID (solve_banded LAYOUT)
+    first, values = splineBasis(knots, nanometers, order)
+    rows = np.repeat(np.arange(nanometers.size), order + 1)
+    cols = (first[:,np.newaxis] + np.arange(order + 1)).ravel()
+    values = values.ravel()
+    keep = values != 0
+    rows, cols, values = rows[keep], cols[keep], values[keep]
+    below = max(0, (rows - cols).max())
+    above = max(0, (cols - rows).max())
+    banded = np.zeros((below + above + 1, nanometers.size))
+    banded[above + rows - cols, cols] = values
+    
+    operator = (banded, (below, above), splineBasis(knots, target, order), target)
+    if len(_operator_cache) >= 16: _operator_cache.clear()
+    _operator_cache[key] = operator
+    return operator
+
+def resampleStack(operator, stack):
+    """Apply a resampleOperator to a (spectra x source wavelengths) stack in one pass"""
+    from scipy import linalg
+    banded, bands, (first, values), target = operator
+    coefficients = linalg.solve_banded(bands, banded, np.transpose(stack))
+    resampled = np.zeros((target.size, coefficients.shape[1]))
+    for i in range(values.shape[1]):
+        resampled += values[:,i,np.newaxis] * coefficients[first + i]
+    return resampled.transpose()
+
+def resampleSpectra(spectra, min_reflct, max_reflct, intrp, prepare=None):
+    """ Interpolate a list of raw (nanometers, reflectances) spectra onto the intrp grid and
+        return (nanometers, reflectances array) with one row per spectrum in input order.
+        Spectra that share a source grid with at least SHARED_GRID_MIN_FILES - 1 others are
+        resampled together through one cached resampleOperator; the rest are fit one by one.
+        prepare(nanometers, stack), e.g. normalizeStack, is applied to the (spectra x
+        wavelengths) stack of each source grid before it is interpolated.
+    """
+    groups = {}
+    for count, (nanometers, reflectances) in enumerate(spectra):
+        groups.setdefault(nanometers.tostring(), []).append(count)
+    
+    target = np.arange(float(min_reflct),float(max_reflct)+1.0,intrp)
+    rows = np.zeros((len(spectra), target.size))
+    for key, members in groups.iteritems():
+        nanometers = spectra[members[0]][0]
+        stack = np.array([spectra[count][1] for count in members])
+        if prepare != None:
+            stack = prepare(nanometers, stack)
+        if len(members) >= SHARED_GRID_MIN_FILES:
+            operator = resampleOperator(nanometers, min_reflct, max_reflct, intrp)
+            rows[members] = resampleStack(operator, stack)
+        else:
+            for count, reflectances in zip(members, stack):
+                rows[count], target = interpolateSpectrum(nanometers, reflectances, \
+                                                          min_reflct, max_reflct, intrp)
+    return (target, rows)
+
+# LOADED REFERENCE SPECTRA KEYED BY (PATH, MODIFICATION TIME, READ SETTINGS)
+_reference_cache = {}
+
+def loadReference(filename, min_reflct, max_reflct, header=False, format='auto'):
+    """ Read a dark or white reference file once and return its raw (nanometers, counts) in
+        the min_reflct-max_reflct window
+    """
+    key = (os.path.abspath(filename), os.stat(filename).st_mtime, min_reflct, max_reflct, header, format)
+    if key not in _reference_cache:
+        nanometers, counts, metadata = loadSpectrum(filename, min_reflct, max_reflct, header, format)
+        if nanometers.size == 0:
+            raise ValueError, "No spectral data between %s and %s nm in reference %s." % (min_reflct, max_reflct, filename)
+        _reference_cache[key] = (nanometers, counts)
+    return _reference_cache[key]
+
+def alignReference(reference, nanometers):
+    """Return a (nanometers, counts) reference on the nanometers grid, linearly interpolated if it was sampled elsewhere"""
+    reference_nm, counts = reference
+    if reference_nm.shape == nanometers.shape and np.array_equal(reference_nm, nanometers):
+        return counts
+    return np.interp(nanometers, reference_nm, counts)
+
+def normalizeStack(stack, dark=None, white=None, clip=None):
+    """ Turn a (spectra x wavelengths) stack of raw counts into percent reflectance in whole
+        array operations: subtract the dark counts, divide by the dark-corrected white counts
+        and clip to clip=(lower, upper). dark and white are already on the stack's grid and are
+        broadcast over every row; wavelengths where the white is not above the dark become 0.
+    """
+    stack = np.asarray(stack, dtype=float)
+    if dark is not None:
+        stack = stack - dark
+    if white is not None:
+        if dark is not None: white = white - dark
+        scale = np.zeros(white.shape)
+        scale[white > 0] = 100.0 / white[white > 0]
+        stack = stack * scale
+    if clip != None:
+        stack = np.clip(stack, clip[0], clip[1])
+    return stack
+
+# SCREENING DEFAULTS FOR screenSpectra
+SPIKE_WINDOW = 9         # POINTS IN THE ROLLING MEDIAN A SPIKE STANDS OUT FROM
+NOISE_WINDOW = 31        # POINTS IN THE ROLLING MAD THAT SETS THE LOCAL NOISE LEVEL
+SPIKE_THRESHOLD = 8.0    # ROBUST Z-SCORE (RESIDUAL / LOCAL SCALED MAD) THAT MARKS A SPIKE
+SPIKE_FLOOR = 0.05       # SPIKES MUST ALSO EXCEED THIS FRACTION OF THE SPECTRUM'S RANGE
+SATURATION_RUN = 5       # CONSECUTIVE POINTS PINNED AT THE MAXIMUM THAT MARK A CLIPPED PEAK
+FLAT_TOLERANCE = 1e-6    # LARGEST RANGE, RELATIVE TO THE MEAN, OF A FLAT LINE
+QC_CHECKS = ['spike', 'saturated', 'flat', 'nonfinite']
+
+def rollingMedian(rows, window=SPIKE_WINDOW, reflect_type='even'):
+    """ Median of the window points around every point of each row of a (spectra x wavelengths)
+        array, computed for all rows at once on a strided view. The ends are padded by mirroring
+        (reflect_type 'even') or by point reflection ('odd'), which continues a straight trend
+        instead of folding it back.
+    """
+    window = min(window, rows.shape[1] - 1 + rows.shape[1] % 2)
+    half = window // 2
+    padded = np.pad(rows, ((0, 0), (half, half)), mode='reflect', reflect_type=reflect_type)
+    windows = np.lib.stride_tricks.as_strided(padded, shape=(rows.shape[0], rows.shape[1], window),
+                                              strides=padded.strides + (padded.strides[1],))
+    return np.median(windows, axis=2)
+
+def runLengthAtLeast(mask, run):
+    """Return for each row of a boolean array whether it has run consecutive True values"""
+    if mask.shape[1] < run:
+        return np.zeros(mask.shape[0], dtype=bool)
+    counts = np.concatenate((np.zeros((mask.shape[0], 1), dtype=int), np.cumsum(mask, axis=1)), axis=1)
+    return ((counts[:,run:] - counts[:,:-run]) == run).any(axis=1)
+
+def screenSpectra(nanometers, rows, colors=None, spike_threshold=SPIKE_THRESHOLD, saturation=None):
+    """ Screen a (spectra x wavelengths) array in whole-array operations and return an OrderedDict
+        of per-spectrum results: spike (a point further off its rolling median than both
+        spike_threshold times the local scaled MAD and SPIKE_FLOOR of the range, so noisy
+        stretches such as the UV end are judged against their own noise) with spike_nm where
+        the largest is, saturated (SATURATION_RUN points pinned at the maximum, or any value at
+        or above saturation), flat (no variation) and nonfinite (NaN or Inf in the spectrum or
+        in its column of the stacked colors, e.g. a hue from arccos of 0/0).
+    """
+    rows = np.asarray(rows, dtype=float).reshape(-1, nanometers.size)
+    results = collections.OrderedDict()
+    finite = np.isfinite(rows)
+    rows = np.where(finite, rows, 0.0)
+    spread = rows.max(axis=1) - rows.min(axis=1)
+    
+    # SPIKES: RESIDUALS FROM A ROLLING MEDIAN AGAINST THE ROLLING MEDIAN ABSOLUTE DEVIATION
+    if rows.shape[1] >= 3:
+        residual = np.abs(rows - rollingMedian(rows, SPIKE_WINDOW, 'odd'))
+        noise = 1.4826 * rollingMedian(residual, NOISE_WINDOW)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            score = residual / np.maximum(spike_threshold * noise, SPIKE_FLOOR * spread[:,np.newaxis])
+    else:
+        score = np.zeros(rows.shape)
+    score[np.isnan(score)] = 0.0
+    flat = spread <= FLAT_TOLERANCE * np.maximum(np.abs(rows.mean(axis=1)), 1.0)
+    results['spike'] = (score > 1).any(axis=1) & ~flat
+    results['spike_nm'] = np.where(results['spike'], nanometers[np.argmax(score, axis=1)], np.nan)
+    
+    # SATURATION: A PLATEAU AT THE MAXIMUM (CLIPPED COUNTS) OR AN EXPLICIT LEVEL
+    pinned = rows >= (rows.max(axis=1) - 1e-4 * spread)[:,np.newaxis]
+    results['saturated'] = runLengthAtLeast(pinned, SATURATION_RUN) & ~flat
+    if saturation != None:
+        results['saturated'] |= (rows >= saturation).any(axis=1)
+    results['flat'] = flat
+    
+    results['nonfinite'] = ~finite.all(axis=1)
+    if colors is not None:
+        results['nonfinite'] |= ~np.isfinite(colors).all(axis=0)
+    return results
+
+class SpectrumSet(object):
+    """ Spectra sharing one wavelength axis, kept as a single contiguous (samples x wavelengths)
+        float matrix with the sample names and a name -> row index. Space for capacity samples
+        is allocated up front and append copies rows straight into it. sample, select, groupBy
+        and wavelengths return views of the matrix rather than copies wherever the rows asked
+        for are contiguous.
+    """
+    def __init__(self, nanometers, reflectances=None, names=None, capacity=0):
+        super(SpectrumSet, self).__init__()
+        self.nanometers = np.asarray(nanometers, dtype=float)
+        if reflectances is None:
+            self._matrix = np.empty((capacity, self.nanometers.size))
+            self.names = []
+        else:
+            self._matrix = np.asarray(reflectances, dtype=float).reshape(-1, self.nanometers.size)
+            self.names = list(names)
+            if len(self.names) != self._matrix.shape[0]:
+                raise ValueError, "%s names given for %s spectra." % (len(self.names), self._matrix.shape[0])
+        self.index = {}
+        for row, name in enumerate(self.names):
+            self.index.setdefault(name, row)
+    
+    @classmethod
+    def fromDataSet(cls, data_set, names):
+        """Wrap a data_set with the nanometers in its first row without copying it"""
+        return cls(data_set[0], data_set[1:], names)
+    
+    def __len__(self):
+        return len(self.names)
+    
+    @property
+    def reflectances(self):
+        """The (samples x wavelengths) matrix of the samples held so far"""
+        return self._matrix[:len(self.names)]
+    
+    def append(self, rows, names):
+        """Copy a (samples x wavelengths) array of rows named names onto the end of the set"""
+        rows = np.asarray(rows, dtype=float).reshape(-1, self.nanometers.size)
+        start = len(self.names)
+        end = start + rows.shape[0]
+        if end > self._matrix.shape[0]:
+            # GROW GEOMETRICALLY SO REPEATED APPENDS STAY LINEAR
+            matrix = np.empty((max(end, 2 * self._matrix.shape[0]), self.nanometers.size))
+            matrix[:start] = self._matrix[:start]
+            self._matrix = matrix
+        self._matrix[start:end] = rows
+        for row, name in enumerate(names, start):
+            self.index.setdefault(name, row)
+        self.names.extend(names)
+    
+    def sample(self, name):
+        """The reflectances of one sample as a view of the matrix"""
+        return self.reflectances[self.index[name]]
+    
+    def select(self, names):
+        """ Return a SpectrumSet of the samples in names (or a slice of rows). A run of
+            consecutive rows is a view of this set; anything else is copied.
+        """
+        if isinstance(names, slice):
+            return SpectrumSet(self.nanometers, self.reflectances[names], self.names[names])
+        rows = np.array([self.index[name] for name in names], dtype=int)
+        if rows.size > 0 and np.array_equal(rows, np.arange(rows[0], rows[0] + rows.size)):
+            return self.select(slice(rows[0], rows[0] + rows.size))
+        return SpectrumSet(self.nanometers, self.reflectances[rows], [self.names[row] for row in rows])
+    
+    def groupBy(self, key):
+        """ Split the samples by key(name), e.g. classifyTissue, and return an OrderedDict of
+            key -> SpectrumSet in order of first appearance. The groups are views of this set
+            when each is already one run of rows, otherwise of a single copy ordered by group.
         """
-        min_reflct = float(min_reflct)
-        max_reflct = float(max_reflct) + 1.0
+        groups = collections.OrderedDict()
+        for row, name in enumerate(self.names):
+            groups.setdefault(key(name), []).append(row)
+        order = list(itertools.chain(*groups.values()))
+        grouped = self
+        if order != range(len(self.names)):
+            grouped = SpectrumSet(self.nanometers, self.reflectances[order], [self.names[row] for row in order])
+        start = 0
+        for value, rows in groups.items():
+            groups[value] = grouped.select(slice(start, start + len(rows)))
+            start += len(rows)
+        return groups
+    
+    def wavelengths(self, lower, upper):
+        """Return a SpectrumSet view of the lower-upper nm range (upper included)"""
+        start = np.searchsorted(self.nanometers, lower, side='left')
+        end = np.searchsorted(self.nanometers, upper, side='right')
+        return SpectrumSet(self.nanometers[start:end], self.reflectances[:,start:end], self.names)
+    
+    def dataSet(self):
+        """Return a copy as one array with the nanometers in its first row"""
+        return np.vstack((self.nanometers, self.reflectances))
+
+def spectrumArrays(data_set):
+    """ Return (nanometers, reflectances) of a SpectrumSet or of a data_set array with the
+        nanometers in its first row, without copying either
+    """
+    if isinstance(data_set, SpectrumSet):
+        return (data_set.nanometers, data_set.reflectances)
+    return (data_set[0], data_set[1:])
+
+class RunningStats(object):
+    """ Per-wavelength count, mean and sum of squared deviations of a stream of spectra. Each
+        update folds in a whole chunk with Chan et al.'s pairwise form of Welford's method, so
+        one pass in memory bounded by the chunk gives the mean, std, standard error and
+        confidence band, and the stats of separate streams can be merged.
+    """
+    def __init__(self, nanometers):
+        super(RunningStats, self).__init__()
+        self.nanometers = np.asarray(nanometers, dtype=float)
+        self.count = 0
+        self.mean = np.zeros(self.nanometers.size)
+        self.m2 = np.zeros(self.nanometers.size)
+    
+    def update(self, rows):
+        """Fold a (spectra x wavelengths) chunk into the stats"""
+        rows = np.asarray(rows, dtype=float).reshape(-1, self.nanometers.size)
+        if len(rows) == 0: return self
+        mean = rows.mean(axis=0)
+        return self.combine(len(rows), mean, ((rows - mean) ** 2).sum(axis=0))
+    
+    def combine(self, count, mean, m2):
+        """Fold in the count, mean and sum of squared deviations of another set of spectra"""
+        if count == 0: return self
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / float(total))
+        self.m2 = self.m2 + m2 + delta ** 2 * (self.count * count / float(total))
+        self.count = total
+        return self
+    
+    def merge(self, other):
+        """Fold in the stats of another RunningStats on the same grid"""
+        return self.combine(other.count, other.mean, other.m2)
+    
+    def variance(self, ddof=0):
+        """Per-wavelength variance (nan when there are no more than ddof spectra)"""
+        if self.count <= ddof:
+            return np.empty(self.nanometers.size) * np.nan
+        return self.m2 / (self.count - ddof)
+    
+    def std(self, ddof=1):
+        """Per-wavelength standard deviation, by default of a sample"""
+        return np.sqrt(self.variance(ddof))
+    
+    def sem(self):
+        """Per-wavelength standard error of the mean"""
+        return self.std(1) / np.sqrt(max(self.count, 1))
+    
+    def confidence(self, level=0.95):
+        """Return the (lower, upper) Student's t confidence band of the mean"""
+        from scipy import stats
+        if self.count < 2:
+            half = np.empty(self.nanometers.size) * np.nan
+        else:
+            half = stats.t.ppf(0.5 + level / 2.0, self.count - 1) * self.sem()
+        return (self.mean - half, self.mean + half)
+
+def filePrefix(filename):
+    """ Return the sample prefix of a file name: the name without extension up to the first
+        '_', '-', '.' or space, less trailing digits (CRL389_00.txt -> CRL, dorsal016.txt -> dorsal)
+    """
+    fname = os.path.splitext(os.path.basename(filename))[0]
+    for separator in '_-. ':
+        fname = fname.split(separator)[0]
+    return fname.rstrip('0123456789') or fname
+
+class GroupedStats(object):
+    """ A RunningStats for each group of samples, where key(name) gives the group of a sample
+        (e.g. filePrefix or spec.py's classifyTissue). Without a key every sample is in the
+        group 'all'; samples the key gives None for go in 'other'.
+    """
+    def __init__(self, key=None):
+        super(GroupedStats, self).__init__()
+        self.key = key
+        self.groups = collections.OrderedDict()
+    
+    def update(self, data_set, names):
+        """Fold a SpectrumSet or nanometers-first array of spectra named names into their groups"""
+        nanometers, reflectances = spectrumArrays(data_set)
+        if self.key == None:
+            members = {'all': slice(None)}
+            order = ['all']
+        else:
+            members = collections.OrderedDict()
+            for row, name in enumerate(names):
+                group = self.key(name)
+                if group == None: group = 'other'
+                members.setdefault(group, []).append(row)
+            order = members.keys()
+        for group in order:
+            if group not in self.groups:
+                self.groups[group] = RunningStats(nanometers)
+            self.groups[group].update(reflectances[members[group]])
+        return self
+    
+    def merge(self, other):
+        """Fold in the groups of another GroupedStats"""
+        for group, stats in other.groups.iteritems():
+            if group not in self.groups:
+                self.groups[group] = RunningStats(stats.nanometers)
+            self.groups[group].merge(stats)
+        return self
+
+def saveStats(stats, fout, level=0.95):
+    """ Save the count, mean, std, standard error and confidence band of every group of a
+        GroupedStats as one table with a row per nanometer
+    """
+    groups = stats.groups.items()
+    if len(groups) == 0:
+        raise ValueError, "No spectra to summarize."
+    columns = [groups[0][1].nanometers]
+    column_names = ['nanometers']
+    for group, group_stats in groups:
+        lower, upper = group_stats.confidence(level)
+        columns.extend([np.ones(group_stats.nanometers.size) * group_stats.count, group_stats.mean,
+                        group_stats.std(), group_stats.sem(), lower, upper])
+        column_names.extend(['%s %s' % (group, name) for name in \
+                             ['n', 'mean', 'std', 'sem', 'ci%g lower' % (level * 100), 'ci%g upper' % (level * 100)]])
+    fout = open(fout,'w')
+    fout.write(','.join(column_names) + '\n')
+    np.savetxt(fout, np.column_stack(columns), delimiter=',', fmt='%1.4f')
+    fout.close()
+
+# BANDS plotMean CAN SHADE AROUND THE MEAN
+PLOT_BANDS = ['var', 'std', 'sem', 'ci']
+
+def plotMean(data_set, band='var', level=0.95):
+    """ Plot the mean spectrum shaded by band: the variance (var), standard deviation (std),
+        standard error (sem) or level confidence band (ci). data_set can be a RunningStats
+        built while streaming as well as a SpectrumSet or nanometers-first array.
+    """
+    import matplotlib.pyplot as plt
+    stats = data_set
+    if not isinstance(stats, RunningStats):
+        nanometers, reflectances = spectrumArrays(data_set)
+        stats = RunningStats(nanometers).update(reflectances)
+    x = stats.nanometers
+    mean = stats.mean
+    if band == 'ci':
+        lower_var, upper_var = stats.confidence(level)
+    else:
+        spread = {'var': stats.variance, 'std': stats.std, 'sem': stats.sem}[band]()
+        upper_var = mean + spread
+        lower_var = mean - spread
+    plt.xlabel('Nanometers')
+    plt.ylabel('Reflectance')
+    maxy = mean.max() + 3
+    plt.ylim(0, maxy)
+    plt.xlim(x.min(), x.max())
+    plt.fill_between(x, upper_var, lower_var, alpha=0.15, color='k')
+    plt.plot(x,mean,'k')
+
+def plotThumbs(data_set, header_list):
+    import matplotlib.pyplot as plt
+    x, reflectances = spectrumArrays(data_set)
+    numb_cols = len(reflectances) + 1
+    cols = int(np.sqrt(numb_cols))
+    rows = cols + 1
+    plt.figure()
+    counter = 0
+    
+    for r in np.arange(0,rows):
+        for c in np.arange(0,cols):
+            if counter == numb_cols-1: break
             
-        in_data_flag = False
-
-        fin = open(filename,'r')
-        reflectances = []
-        nanometers = []
-        if header == True:
-            for count, line in enumerate(fin):
-                if "End" in line: break
-
-                if in_data_flag == True:
-                    line_parts = line.strip().split()
-                    if float(line_parts[0]) >= min_reflct:
-                        nanometers.append(float(line_parts[0]))
-                        reflectances.append(float(line_parts[1]))
-                    if float(line_parts[0]) > max_reflct: break
-                    
-                if "Begin" in line: 
-                    in_data_flag = True
+            ax = plt.subplot2grid((rows,cols),(r,c))
+            y = reflectances[counter]
+            ax.annotate(header_list[counter], xy=(.5, .5),  xycoords='axes fraction',
+                            horizontalalignment='center', verticalalignment='center')
+            ax.set_ylim(0, 50)
+            plt.plot(x,y)
+            counter += 1
+
+class Coloration(object):
+    """ A processing session for one set of settings. The wavelength grid, the color schemes
+        compiled for it and the smoothing kernel are built once in __init__, so a long-running
+        caller can process spectra again and again without repeating the setup. Interpolation
+        operators are cached per source grid by resampleOperator.
+    """
+    def __init__(self, min_nm=300, max_nm=700, intrp=1.0, header=False, smooth=False,
+                 window_type='hanning', window_length=100, schemes=DEFAULT_SCHEMES, format='auto',
+                 dark=None, white=None, clip=None):
+        super(Coloration, self).__init__()
+        if window_type not in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
+            raise ValueError, "Window is on of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'"
+        if format != 'auto' and format not in READERS:
+            raise ValueError, "Format is one of 'auto', '%s'" % ("', '".join(READERS.keys()))
+        self.min_nm = min_nm
+        self.max_nm = max_nm
+        self.intrp = intrp
+        self.header = header
+        self.format = format
+        self.smooth_spectra = smooth
+        self.window_type = window_type
+        self.window_length = window_length
         
-        else:
-            for count, line in enumerate(fin):
-                line_parts = line.strip().split()
-                if float(line_parts[0]) >= min_reflct:
-                    nanometers.append(float(line_parts[0]))
-                    reflectances.append(float(line_parts[1]))
-                if float(line_parts[0]) > max_reflct: break
-                
-        basename = os.path.basename(filename)     
-        reflectances = numpy.array(reflectances)
-        nanometers = numpy.array(nanometers)
+        # SETUP SHARED BY EVERY CALL
+        self.nanometers = np.arange(float(min_nm),float(max_nm)+1.0,intrp)
+        self.schemes = [checkScheme(scheme) for scheme in schemes]
+        self.compiled = compileSchemes(self.nanometers, self.schemes)
         
-        # INTERPOLATE VALUES TO 1 NM INCREMENTS
-        tck = interpolate.splrep(nanometers,reflectances,xb=min_reflct,s=0)
-        nanometers = numpy.arange(min_reflct,max_reflct,intrp)
-        reflectances = interpolate.splev(nanometers,tck,der=0)
-        return (numpy.array(reflectances), numpy.array(nanometers), basename)
-
-    def plotMean(self, data_set):
-        mean = data_set[1:].mean(axis=0)
-        x = data_set.transpose()[:,0]
-        mean = data_set[1:].mean(axis=0)
-        var = data_set[1:].var(axis=0)
-        upper_var = mean + var
-        lower_var = mean - var
-        xlabel('Nanometers')
-        ylabel('Reflectance')
-        maxy = mean.max() + 3
-        ylim(0, maxy)
-        xlim(data_set.transpose()[:,0].min(), data_set.transpose()[:,0].max())
-        fill_between(x, upper_var, lower_var, alpha=0.15, color='k')
-        plot(x,mean,'k')
-
+        # RAW-COUNT CLEANING: REFERENCE FILES ARE READ HERE AND PUT ON EACH SOURCE GRID ONCE
+        self.dark = None
+        self.white = None
+        if dark != None: self.dark = loadReference(dark, float(min_nm), float(max_nm), header, format)
+        if white != None: self.white = loadReference(white, float(min_nm), float(max_nm), header, format)
+        self.clip = clip
+        self.references = {}
+        self.kernel = None
+        if smooth and window_length >= 3:
+            self.kernel = getWindow(window_length, window_type)
+    
+    @classmethod
+    def fromArgs(cls, args):
+        """Start a session with the settings of parsed spec.py arguments"""
+        schemes = DEFAULT_SCHEMES
+        if args.schemes != None: schemes = loadSchemes(args.schemes)
+        return cls(args.min_nm, args.max_nm, args.intrp, args.header, args.smooth, \
+                   args.window_type, args.window_length, schemes, args.format, \
+                   args.dark, args.white, args.clip)
+    
+    def getFilenames(self, path2dir):
+        """Parse file names in directory"""
+        return getFilenames(path2dir)
+    
+    def smooth(self, x, window_len=None, window=None):
+        """Smooth one spectrum, with the session window unless another one is given"""
+        if window_len == None: window_len = self.window_length
+        if window == None: window = self.window_type
+        return smooth(x, window_len, window)
+    
+    def parseSpectrum(self, text):
+        """Return the raw (nanometers, reflectances, metadata) inside the session range from the text of a file"""
+        return parseSpectrum(text, float(self.min_nm), float(self.max_nm) + 1.0, self.header, self.format)
+    
+    def parseSpectralText(self, text):
+        """Return the raw (nanometers, reflectances) inside the session range from the text of a file"""
+        return self.parseSpectrum(text)[:2]
+    
+    def loadSpectrum(self, filename):
+        """Return the raw (nanometers, reflectances, metadata) inside the session range from a file"""
+        return loadSpectrum(filename, self.min_nm, self.max_nm, self.header, self.format)
+    
+    def readSpectrum(self, filename):
+        """Return the raw (nanometers, reflectances) inside the session range from a file"""
+        return readSpectrum(filename, self.min_nm, self.max_nm, self.header, self.format)
+    
+    def parseFile(self, filename):
+        """Read and interpolate one file on its own; returns (reflectances, nanometers, basename)"""
+        return parseFile(filename, self.min_nm, self.max_nm, self.header, self.intrp, self.format)
+    
+    def prepareStack(self, nanometers, stack):
+        """Apply the session dark, white and clipping to a raw stack sampled at nanometers"""
+        key = nanometers.tostring()
+        if key not in self.references:
+            dark, white = None, None
+            if self.dark != None: dark = alignReference(self.dark, nanometers)
+            if self.white != None: white = alignReference(self.white, nanometers)
+            if len(self.references) >= 16: self.references.clear()
+            self.references[key] = (dark, white)
+        dark, white = self.references[key]
+        return normalizeStack(stack, dark, white, self.clip)
+    
+    def resample(self, spectra):
+        """ Clean (see prepareStack) and interpolate raw (nanometers, reflectances) spectra onto the
+            session grid. Returns a list with one row per spectrum (None where the fit failed) and
+            a list of (index, error).
+        """
+        prepare = None
+        if self.dark != None or self.white != None or self.clip != None:
+            prepare = self.prepareStack
+        try:
+            nm, rows = resampleSpectra(spectra, self.min_nm, self.max_nm, self.intrp, prepare)
+            return (list(rows), [])
+        except Exception:
+            # FALL BACK TO ONE FIT PER SPECTRUM SO A BAD ONE ONLY LOSES ITSELF
+            rows = []
+            errors = []
+            for count, (nanometers, reflectances) in enumerate(spectra):
+                try:
+                    if prepare != None: reflectances = prepare(nanometers, reflectances[np.newaxis,:])[0]
+                    reflectances, nm = interpolateSpectrum(nanometers, reflectances, self.min_nm, self.max_nm, self.intrp)
+                except Exception, e:
+                    errors.append((count, '%s: %s' % (e.__class__.__name__, e)))
+                    reflectances = None
+                rows.append(reflectances)
+            return (rows, errors)
+    
+    def windowSpectrum(self, nanometers, reflectances):
+        """Return the raw (nanometers, reflectances) of an in-memory spectrum inside the session range"""
+        return windowSpectrum(nanometers, reflectances, float(self.min_nm), float(self.max_nm) + 1.0)
+    
+    def smoothRows(self, rows):
+        """Smooth a (spectra x wavelengths) array with the session kernel if smoothing is on"""
+        if not self.smooth_spectra or len(rows) == 0:
+            return rows
+        return smoothArray(rows, self.window_length, self.window_type, kernel=self.kernel)
+    
+    def processFiles(self, filenames):
+        """ Read, interpolate and smooth filenames in this process. Returns (spectra, header_list,
+            errors) where spectra is a SpectrumSet on the session grid and errors lists the
+            (filename, error) of files that were left out.
+        """
+        spectra = []
+        read = []
+        errors = []
+        for filename in filenames:
+            try:
+                nanometers, reflectances = self.readSpectrum(filename)
+                if nanometers.size <= 3:
+                    raise ValueError, "Not enough spectral data between %s and %s nm." % (self.min_nm, self.max_nm)
+            except Exception, e:
+                errors.append((filename, '%s: %s' % (e.__class__.__name__, e)))
+                continue
+            spectra.append((nanometers, reflectances))
+            read.append(filename)
+        
+        rows, failures = self.resample(spectra)
+        for count, error in failures:
+            errors.append((read[count], error))
+        header_list = [os.path.basename(filename) for filename, row in zip(read, rows) if row is not None]
+        rows = np.array([row for row in rows if row is not None]).reshape(-1, self.nanometers.size)
+        return (SpectrumSet(self.nanometers, self.smoothRows(rows), header_list), header_list, errors)
+    
+    def processSpectra(self, spectra, names):
+        """ Clean, interpolate and smooth raw (nanometers, reflectances) spectra named names, all
+            together. Returns (spectra, errors) where spectra is a SpectrumSet on the session grid
+            and errors lists the (name, error) of spectra that were left out.
+        """
+        rows, failures = self.resample(spectra)
+        errors = [(names[count], error) for count, error in failures]
+        kept = [name for name, row in zip(names, rows) if row is not None]
+        rows = np.array([row for row in rows if row is not None]).reshape(-1, self.nanometers.size)
+        return (SpectrumSet(self.nanometers, self.smoothRows(rows), kept), errors)
+    
+    def measure(self, data_set):
+        """ Return the stacked (rows x samples) measurments of every session color scheme, using
+            the schemes compiled in __init__ when data_set is on the session grid
+        """
+        nanometers = spectrumArrays(data_set)[0]
+        if nanometers.shape == self.nanometers.shape and np.array_equal(nanometers, self.nanometers):
+            return schemeMeasurments(data_set, compiled=self.compiled)
+        return schemeMeasurments(data_set, self.schemes)
+    
+    def calcColorMeasurments(self, data_set):
+        """Return a (name, row labels, table) for every session color scheme"""
+        return splitColors(self.measure(data_set), self.schemes)
+    
+    def printCSV(self, data_set, column_names, row_names, fout=sys.stdout):
+        """Print files as table"""
+        printCSV(data_set, column_names, row_names, fout)
+    
+    def printColors(self, colors, column_names, fout=sys.stdout):
+        """Print the table of every session color scheme from measure"""
+        printColors(colors, column_names, fout, self.schemes)
+    
+    def saveCSV(self, data_set, column_names, fout):
+        """Save files as table"""
+        saveCSV(data_set, column_names, fout)
+    
+    def plotMean(self, data_set, band='var', level=0.95):
+        plotMean(data_set, band, level)
+    
     def plotThumbs(self, data_set, header_list):
-        data_set = data_set.transpose()
-        numb_cols = data_set.shape[1]
-        cols = int(sqrt(numb_cols))
-        rows = cols + 1
-        x = data_set[:,0]
-        plt.figure()
-        counter = 0
-        for r in arange(0,rows):
-            for c in arange(0,cols):
-                if counter == data_set.shape[1]-1: break
-                ax = plt.subplot2grid((rows,cols),(r,c))
-                y = data_set[:,counter+1]
-                ax.annotate(header_list[counter], xy=(.5, .5),  xycoords='axes fraction',
-                                horizontalalignment='center', verticalalignment='center')
-                plt.plot(x,y)
-                counter += 1
\ No newline at end of file
+        plotThumbs(data_set, header_list)
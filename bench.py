@@ -0,0 +1,666 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bench.py
+
+Benchmarks for the spec.py pipeline. Each benchmark checks that the fast code
+path returns the same values as the original implementation before timing it;
+the color measurments are checked by test_colors.py.
+
+Examples:
+
+python bench.py parse --repeat 20
+
+# STAGE TIMINGS ON SYNTHETIC DIRECTORIES, FAILING IF ANY STAGE IS SLOWER THAN THE STORED BASELINE
+python bench.py suite --sizes 10,1000 --baseline bench_baseline.json
+
+# RECORD A NEW BASELINE (100000 FILES NEEDS ABOUT 5 GB OF DISK)
+python bench.py suite --sizes 10,1000,100000 --save-baseline bench_baseline.json
+
+"""
+
+import os
+import sys
+import time
+import tempfile
+import subprocess
+import argparse
+import json
+import collections
+import shutil
+import numpy as np
+
+import spec
+from test_colors import legacy_calcColorMeasurments
+from Coloration import Coloration, getFilenames, smooth, smoothArray, FFT_WINDOW_LENGTH, normalizeStack, \
+    splitColors, calcColorMeasurments, readSpectrum, interpolateSpectrum, parseFile, resampleOperator, \
+    resampleSpectra, SpectrumSet, RunningStats, GroupedStats, SPIKE_THRESHOLD, QC_CHECKS, screenSpectra, \
+    plotThumbs, _operator_cache
+
+TEST_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data')
+
+def get_args():
+    """Parse sys.argv"""
+    parser = argparse.ArgumentParser(prog='bench.py',
+        description='Time the spec.py pipeline stages on the bundled test_data spectra.')
+
+    parser.add_argument('benchmark', nargs='*', default=['all'],
+        help='Benchmarks to run: parse, interpolate, smooth, normalize, colors, spectra, stats, qc, classify, startup, thumbs, service, suite, readahead or all. Default is all.')
+
+    parser.add_argument('--repeat', type=int, default=10,
+        help='Number of timed repeats. Default is 10.')
+
+    parser.add_argument('--min-nm', type=int, default=300,
+        help='Lowest nm to include. Default is 300 nm.')
+
+    parser.add_argument('--max-nm', type=int, default=700,
+        help='Highest nm to include. Default is 700 nm.')
+
+    parser.add_argument('--samples', type=int, default=1000,
+        help='Number of spectra in synthetic stacks. Default is 1000.')
+
+    parser.add_argument('--sizes', default='10,1000',
+        help='Comma separated numbers of files per synthetic directory for the suite. Default is 10,1000.')
+
+    parser.add_argument('--formats', default=','.join([name for name, template, header in FORMATS]),
+        help='Comma separated file formats for the suite. Default is all of them.')
+
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'spec_bench'),
+        help='Where the synthetic directories are written and kept between runs.')
+
+    parser.add_argument('-j','--jobs', type=int, default=1,
+        help='Number of worker processes spec.py uses in the suite. Default is 1.')
+
+    parser.add_argument('--baseline', metavar='FILE',
+        help='Compare the suite against the timings stored in FILE and exit with status 1 on a slowdown.')
+
+    parser.add_argument('--save-baseline', metavar='FILE',
+        help='Store the suite timings in FILE.')
+
+    parser.add_argument('--tolerance', type=float, default=0.5,
+        help='Allowed slowdown over the baseline as a fraction. Default is 0.5 (50%%).')
+
+    return parser.parse_args()
+
+def best_of(func, repeat):
+    """Return the fastest wall time in seconds of repeat calls to func"""
+    times = []
+    for count in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+def report(name, old, new):
+    """Print a timing line comparing old and new implementations"""
+    print "%-40s old %9.2f ms   new %9.2f ms   speedup %6.1fx" % \
+        (name, old * 1000, new * 1000, old / new)
+
+def test_sets():
+    """Return (label, filenames, header) for each bundled test directory"""
+    return [('testfiles_with_headers', getFilenames(os.path.join(TEST_DATA, 'testfiles_with_headers')), True),
+            ('testfiles_no_headers', getFilenames(os.path.join(TEST_DATA, 'testfiles_no_headers')), False),
+            ('spec_format_versions', getFilenames(os.path.join(TEST_DATA, 'spec_format_versions')), True)]
+
+def spectrum_stack(samples, min_nm=300, max_nm=700):
+    """Return (nanometers, samples x wavelengths array) tiled from the interpolated test spectra"""
+    filenames = getFilenames(os.path.join(TEST_DATA, 'testfiles_with_headers'))
+    rows = []
+    for filename in filenames:
+        reflectances, nm, header = parseFile(filename, min_nm, max_nm, True, 1.0)
+        rows.append(reflectances)
+    rows = np.array(rows)
+    return (nm, rows[np.arange(samples) % len(rows)])
+
+# ORIGINAL IMPLEMENTATIONS KEPT AS REFERENCES
+
+def legacy_readSpectrum(filename, min_reflct, max_reflct, header):
+    """Per-line parse loop used by parseFile before the bulk loader"""
+    min_reflct = float(min_reflct)
+    max_reflct = float(max_reflct) + 1.0
+    in_data_flag = False
+    fin = open(filename,'r')
+    reflectances = []
+    nanometers = []
+    if header == True:
+        for count, line in enumerate(fin):
+            if "End" in line: break
+            if in_data_flag == True:
+                line_parts = line.strip().split()
+                if float(line_parts[0]) >= min_reflct:
+                    nanometers.append(float(line_parts[0]))
+                    reflectances.append(float(line_parts[1]))
+                if float(line_parts[0]) > max_reflct: break
+            if "Begin" in line:
+                in_data_flag = True
+    else:
+        for count, line in enumerate(fin):
+            line_parts = line.strip().split()
+            if float(line_parts[0]) >= min_reflct:
+                nanometers.append(float(line_parts[0]))
+                reflectances.append(float(line_parts[1]))
+            if float(line_parts[0]) > max_reflct: break
+    fin.close()
+    return (np.array(nanometers), np.array(reflectances))
+
+# BENCHMARKS
+
+def bench_parse(args):
+    """Bulk loader vs. the per-line parse loop"""
+    print '\nparse (%s-%s nm)' % (args.min_nm, args.max_nm)
+    for label, filenames, header in test_sets():
+        for filename in filenames:
+            old = legacy_readSpectrum(filename, args.min_nm, args.max_nm, header)
+            new = readSpectrum(filename, args.min_nm, args.max_nm, header)
+            assert np.array_equal(old[0], new[0]) and np.array_equal(old[1], new[1]), filename
+            # THE SNIFFED FORMAT NEEDS NO --header
+            new = readSpectrum(filename, args.min_nm, args.max_nm, not header)
+            assert np.array_equal(old[0], new[0]) and np.array_equal(old[1], new[1]), filename
+
+        old = best_of(lambda: [legacy_readSpectrum(f, args.min_nm, args.max_nm, header) for f in filenames], args.repeat)
+        new = best_of(lambda: [readSpectrum(f, args.min_nm, args.max_nm, header) for f in filenames], args.repeat)
+        report('%s (%s files)' % (label, len(filenames)), old, new)
+
+        # SAME COMPARISON OVER THE WHOLE FILE
+        old = best_of(lambda: [legacy_readSpectrum(f, 0, 10000, header) for f in filenames], args.repeat)
+        new = best_of(lambda: [readSpectrum(f, 0, 10000, header) for f in filenames], args.repeat)
+        report('%s full range' % (label), old, new)
+
+def bench_smooth(args):
+    """Batched smoothArray vs. smooth() on every row, and the direct/FFT crossover"""
+    nm, stack = spectrum_stack(args.samples, args.min_nm, args.max_nm)
+    print '\nsmooth (%s spectra x %s nm)' % stack.shape
+    for window_len in [5, 25, 100]:
+        old_rows = np.array([smooth(row, window_len, 'hanning') for row in stack])
+        for method in ['direct', 'fft']:
+            assert np.allclose(old_rows, smoothArray(stack, window_len, 'hanning', method)), (window_len, method)
+
+        old = best_of(lambda: [smooth(row, window_len, 'hanning') for row in stack], args.repeat)
+        new = best_of(lambda: smoothArray(stack, window_len, 'hanning'), args.repeat)
+        report('window-length %s' % (window_len), old, new)
+
+    print '\ndirect vs. fft convolution (auto switches at window-length %s)' % (FFT_WINDOW_LENGTH)
+    crossover = None
+    for window_len in [3, 5, 9, 15, 25, 35, 50, 75, 100, 150, 200]:
+        direct = best_of(lambda: smoothArray(stack, window_len, 'hanning', 'direct'), args.repeat)
+        fft = best_of(lambda: smoothArray(stack, window_len, 'hanning', 'fft'), args.repeat)
+        if crossover == None and fft < direct: crossover = window_len
+        print "window-length %-26s direct %9.2f ms   fft %9.2f ms" % (window_len, direct * 1000, fft * 1000)
+    print 'fft is faster from window-length %s' % (crossover)
+
+def bench_interpolate(args):
+    """Shared-grid resampleSpectra vs. one spline fit per file"""
+    print '\ninterpolate (%s spectra per grid)' % (args.samples)
+    for label, filenames, header in test_sets():
+        spectra = [readSpectrum(f, args.min_nm, args.max_nm, header) for f in filenames]
+        spectra = [spectra[count % len(spectra)] for count in range(args.samples)]
+        old_rows = np.array([interpolateSpectrum(nm, r, args.min_nm, args.max_nm, 1.0)[0] for nm, r in spectra])
+        nm, new_rows = resampleSpectra(spectra, args.min_nm, args.max_nm, 1.0)
+        assert np.allclose(old_rows, new_rows), label
+
+        old = best_of(lambda: [interpolateSpectrum(nm, r, args.min_nm, args.max_nm, 1.0) for nm, r in spectra], args.repeat)
+        new = best_of(lambda: resampleSpectra(spectra, args.min_nm, args.max_nm, 1.0), args.repeat)
+        report(label, old, new)
+
+        # OPERATOR SETUP COST WITHOUT THE CACHE
+        _operator_cache.clear()
+        setup = best_of(lambda: (_operator_cache.clear(), resampleOperator(spectra[0][0], args.min_nm, args.max_nm, 1.0)), args.repeat)
+        print "%-40s operator setup %.2f ms" % ('', setup * 1000)
+
+def bench_normalize(args):
+    """normalizeStack on a whole stack vs. dark/white/clip applied file by file"""
+    nm, stack = spectrum_stack(args.samples, args.min_nm, args.max_nm)
+    random = np.random.RandomState(0)
+    dark = random.normal(5, 1, nm.size)
+    white = stack.mean(0) * 1.5 + 10
+    def legacy():
+        return np.array([np.clip((row - dark) / (white - dark) * 100, 0, 100) for row in stack])
+    assert np.allclose(legacy(), normalizeStack(stack, dark, white, (0, 100)))
+    print '\nnormalize (%s spectra x %s nm)' % stack.shape
+    old = best_of(legacy, args.repeat)
+    new = best_of(lambda: normalizeStack(stack, dark, white, (0, 100)), args.repeat)
+    report('dark, white and clip', old, new)
+
+def bench_colors(args):
+    """Single-pass band sums vs. the per-author compress loop in calcColorMeasurments"""
+    print '\ncolors (values are checked by test_colors.py)'
+    nm, stack = spectrum_stack(args.samples, args.min_nm, args.max_nm)
+    data_set = np.vstack((nm, stack))
+    old = best_of(lambda: legacy_calcColorMeasurments(data_set), args.repeat)
+    new = best_of(lambda: calcColorMeasurments(data_set), args.repeat)
+    report('%s spectra x %s nm' % stack.shape, old, new)
+
+def bench_spectra(args):
+    """Ragged chunk lists stacked with vstack vs. appending into a preallocated SpectrumSet"""
+    nm, stack = spectrum_stack(args.samples, args.min_nm, args.max_nm)
+    names = ['s%05d_%s.txt' % (count, spec.TISSUES[count % 3]) for count in range(args.samples)]
+    chunks = [(stack[i:i+10], names[i:i+10]) for i in range(0, args.samples, 10)]
+    def legacy():
+        data_set = [nm[np.newaxis,:]]
+        header_list = []
+        for rows, headers in chunks:
+            data_set.append(rows)
+            header_list.extend(headers)
+        data_set = np.vstack(data_set)
+        tissues = {}
+        for tissue in spec.TISSUES:
+            columns = [count for count, name in enumerate(header_list) if spec.classifyTissue(name) == tissue]
+            tissues[tissue] = np.vstack((data_set[0], data_set[1:][columns]))
+        return (data_set, tissues)
+    def new():
+        spectra = SpectrumSet(nm, capacity=len(names))
+        for rows, headers in chunks:
+            spectra.append(rows, headers)
+        return (spectra, spectra.groupBy(spec.classifyTissue))
+    data_set, tissues = legacy()
+    spectra, by_tissue = new()
+    assert np.array_equal(data_set, spectra.dataSet())
+    for tissue in spec.TISSUES:
+        assert np.array_equal(tissues[tissue], by_tissue[tissue].dataSet())
+    # A SET ALREADY IN TISSUE ORDER IS SPLIT WITHOUT COPYING
+    ordered = spectra.select([name for tissue in spec.TISSUES for name in by_tissue[tissue].names])
+    for group in ordered.groupBy(spec.classifyTissue).values():
+        assert np.may_share_memory(group.reflectances, ordered.reflectances)
+    window = spectra.wavelengths(400, 500)
+    assert np.may_share_memory(window.reflectances, spectra.reflectances)
+    assert np.array_equal(window.nanometers, nm[(nm >= 400) & (nm <= 500)])
+    print '\nspectra (%s spectra x %s nm)' % stack.shape
+    report('collect and split by tissue', best_of(legacy, args.repeat), best_of(new, args.repeat))
+
+def bench_stats(args):
+    """One streaming pass of RunningStats over chunks vs. the whole-matrix passes plotMean made"""
+    nm, stack = spectrum_stack(args.samples, args.min_nm, args.max_nm)
+    stack = stack + np.random.RandomState(0).normal(0, 1, stack.shape)
+    names = ['s%05d_%s.txt' % (count, spec.TISSUES[count % 3]) for count in range(args.samples)]
+    def legacy():
+        data_set = np.vstack((nm, stack))
+        mean = data_set[1:].mean(axis=0)
+        mean = data_set[1:].mean(axis=0)
+        var = data_set[1:].var(axis=0)
+        std = data_set[1:].std(axis=0, ddof=1)
+        return (mean, var, std, std / np.sqrt(len(stack)))
+    def new():
+        stats = RunningStats(nm)
+        for i in range(0, args.samples, 100):
+            stats.update(stack[i:i+100])
+        return stats
+    mean, var, std, sem = legacy()
+    stats = new()
+    assert np.allclose(mean, stats.mean, rtol=1e-12) and np.allclose(var, stats.variance(), rtol=1e-10)
+    assert np.allclose(std, stats.std(), rtol=1e-10) and np.allclose(sem, stats.sem(), rtol=1e-10)
+    grouped = GroupedStats(spec.classifyTissue)
+    for i in range(0, args.samples, 100):
+        grouped.update(np.vstack((nm, stack[i:i+100])), names[i:i+100])
+    for count, tissue in enumerate(spec.TISSUES):
+        assert np.allclose(grouped.groups[tissue].mean, stack[count::3].mean(axis=0), rtol=1e-12)
+        assert np.allclose(grouped.groups[tissue].std(), stack[count::3].std(axis=0, ddof=1), rtol=1e-10)
+    print '\nstats (%s spectra x %s nm in chunks of 100)' % stack.shape
+    report('mean, var, std and sem', best_of(legacy, args.repeat), best_of(new, args.repeat))
+
+def legacy_screen(nanometers, rows, spike_threshold=SPIKE_THRESHOLD):
+    """The same screening one spectrum and one wavelength at a time, as it was done by hand"""
+    from Coloration import SPIKE_WINDOW, NOISE_WINDOW, SPIKE_FLOOR, SATURATION_RUN, FLAT_TOLERANCE
+    results = dict([(check, []) for check in QC_CHECKS])
+    for row in rows:
+        size = len(row)
+        spread = row.max() - row.min()
+        residual = []
+        for i in range(size):
+            window = [row[i]]
+            for k in range(1, SPIKE_WINDOW // 2 + 1):
+                window.append(row[i+k] if i + k < size else 2 * row[size-1] - row[2*(size-1)-i-k])
+                window.append(row[i-k] if i - k >= 0 else 2 * row[0] - row[k-i])
+            residual.append(abs(row[i] - np.median(window)))
+        flat = spread <= FLAT_TOLERANCE * max(abs(row.mean()), 1.0)
+        spike = False
+        for i in range(size):
+            window = [residual[min(max(j, -j), 2*(size-1)-j)] for j in range(i - NOISE_WINDOW // 2, i + NOISE_WINDOW // 2 + 1)]
+            limit = max(spike_threshold * 1.4826 * np.median(window), SPIKE_FLOOR * spread)
+            if residual[i] > limit: spike = True
+        pinned = 0
+        saturated = False
+        for value in row:
+            pinned = pinned + 1 if value >= row.max() - 1e-4 * spread else 0
+            if pinned >= SATURATION_RUN: saturated = True
+        results['spike'].append(spike and not flat)
+        results['saturated'].append(saturated and not flat)
+        results['flat'].append(flat)
+        results['nonfinite'].append(not np.isfinite(row).all())
+    return results
+
+def bench_qc(args):
+    """Vectorized screenSpectra vs. screening each spectrum point by point"""
+    nm, stack = spectrum_stack(args.samples, args.min_nm, args.max_nm)
+    stack = stack.copy()
+    stack[::7,200] += 40                           # SPIKES
+    stack[1::7,150:170] = stack[1::7].max(axis=1)[:,np.newaxis] + 5  # CLIPPED PEAKS
+    stack[2::7] = 12.5                             # FLAT LINES
+    small = stack[:min(len(stack), 70)]
+    old = legacy_screen(nm, small)
+    new = screenSpectra(nm, small)
+    for check in QC_CHECKS:
+        assert np.array_equal(old[check], new[check]), check
+    print '\nqc (%s spectra x %s nm)' % small.shape
+    report('spike, saturation, flat and NaN screening', best_of(lambda: legacy_screen(nm, small), 1),
+           best_of(lambda: screenSpectra(nm, small), args.repeat))
+    flags = screenSpectra(nm, stack)
+    print "%-40s new %9.2f ms   %s of %s flagged" % ('%s spectra' % (len(stack)),
+        best_of(lambda: screenSpectra(nm, stack), args.repeat) * 1000,
+        int((flags['spike'] | flags['saturated'] | flags['flat'] | flags['nonfinite']).sum()), len(stack))
+
+def bench_classify(args):
+    """classifyTissue on 100k synthetic filenames, checked against jellyfish when it is installed"""
+    import random
+    random.seed(0)
+    spellings = ['dewlap', 'dorsal', 'ventral', 'drosal', 'dewlp', 'ventrl', 'Dorsal', 'vent', 'dorsa1', 'back']
+    filenames = ['%s%04d_%s_%02d.txt' % (random.choice(['CRL', 'ljr', 'anole']), random.randint(0, 9999),
+                                         random.choice(spellings), random.randint(0, 99)) for count in range(100000)]
+    print '\nclassify (%s filenames)' % (len(filenames))
+    try:
+        import jellyfish
+        for filename in filenames[:2000]:
+            tokens = os.path.splitext(filename)[0].lower().split('_')
+            distances = sorted([(min([jellyfish.hamming_distance(unicode(tissue), unicode(t)) for t in tokens]), count)
+                                for count, tissue in enumerate(spec.TISSUES)])
+            expected = None
+            if distances[0][0] <= spec.MAX_TISSUE_DISTANCE: expected = spec.TISSUES[distances[0][1]]
+            assert spec.classifyTissue(filename) == expected, filename
+    except ImportError:
+        print 'jellyfish is not installed, skipping the cross-check'
+
+    spec._tissue_keys.clear()
+    start = time.time()
+    labels = [spec.classifyTissue(filename) for filename in filenames]
+    elapsed = time.time() - start
+    print "%-40s %9.2f ms   %9.0f filenames/s" % ('cold token cache', elapsed * 1000, len(filenames) / elapsed)
+    elapsed = best_of(lambda: [spec.classifyTissue(filename) for filename in filenames], args.repeat)
+    print "%-40s %9.2f ms   %9.0f filenames/s" % ('warm token cache', elapsed * 1000, len(filenames) / elapsed)
+
+def run_spec(arguments):
+    """Run spec.py in a fresh interpreter with its output discarded"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spec.py')
+    devnull = open(os.devnull, 'w')
+    subprocess.check_call([sys.executable, script] + arguments, stdout=devnull, stderr=devnull)
+    devnull.close()
+
+def bench_startup(args):
+    """Interpreter start-up, import and short CLI runs, checking heavy modules stay unloaded"""
+    print '\nstartup'
+    here = os.path.dirname(os.path.abspath(__file__))
+    check = ('import sys; sys.argv = %r; import spec; spec.main(); '
+             'sys.stderr.write("\\nloaded: " + " ".join([m for m in ("matplotlib", "pylab", "scipy", "jellyfish") '
+             'if m in sys.modules]))')
+    temp_dir = tempfile.mkdtemp(prefix='bench_')
+    output = os.path.join(temp_dir, 'out.csv')
+    cache = os.path.join(temp_dir, 'cache')
+    input_dir = os.path.join(TEST_DATA, 'testfiles_with_headers')
+    conversion = ['-i', input_dir, '-o', output, '--header', '--cache-dir', cache]
+    run_spec(conversion)
+    
+    # ONLY INTERPOLATION NEEDS scipy, SO A WARM CACHE RUNS ON numpy ALONE
+    for label, arguments in [('csv conversion, cold cache', conversion + ['--no-cache']),
+                             ('csv conversion, warm cache', conversion)]:
+        process = subprocess.Popen([sys.executable, '-c', check % (['spec.py'] + arguments)], cwd=here,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        loaded = process.communicate()[1].split('loaded:')[-1].split()
+        print '%-40s %s' % (label + ' imports', ', '.join(loaded) or 'no plotting, matching or scipy modules')
+
+    timings = [('python -c pass', lambda: subprocess.check_call([sys.executable, '-c', 'pass'])),
+               ('import numpy', lambda: subprocess.check_call([sys.executable, '-c', 'import numpy'])),
+               ('import spec', lambda: subprocess.check_call([sys.executable, '-c', 'import spec'], cwd=here)),
+               ('spec.py --help', lambda: run_spec(['--help'])),
+               ('csv conversion, cold cache', lambda: run_spec(conversion + ['--no-cache'])),
+               ('csv conversion, warm cache', lambda: run_spec(conversion))]
+    for label, func in timings:
+        print "%-40s %9.2f ms" % (label, best_of(func, args.repeat) * 1000)
+    import shutil
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+def bench_service(args):
+    """Requests to service.py on localhost at 1, 4 and 16 concurrent clients vs. one spec.py run per file"""
+    import httplib
+    import threading
+    import service
+    filenames = getFilenames(os.path.join(TEST_DATA, 'testfiles_with_headers'))
+    texts = [(os.path.basename(filename), open(filename).read()) for filename in filenames]
+    expected_session = Coloration(args.min_nm, args.max_nm, 1.0, True, True, window_length=25)
+    expected, header_list, errors = expected_session.processFiles(filenames)
+    tables = splitColors(expected_session.measure(expected), expected_session.schemes)
+    
+    session = Coloration(args.min_nm, args.max_nm, 1.0, True, True, window_length=25)
+    server = service.ServiceServer(('127.0.0.1', 0), session)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    host, port = server.server_address
+    
+    def post(connection, name, text):
+        connection.request('POST', '/measure?name=' + name, text, {'Content-Type': 'text/plain'})
+        response = connection.getresponse()
+        body = response.read()
+        assert response.status == 200, body
+        return json.loads(body, object_pairs_hook=collections.OrderedDict)
+    
+    # THE SERVICE GIVES THE SAME VALUES AS AN IN-PROCESS SESSION
+    connection = httplib.HTTPConnection(host, port)
+    for name, text in texts:
+        sample = post(connection, name, text)['samples'][0]
+        assert sample['name'] == name
+        assert np.allclose(sample['reflectances'], expected.sample(name), rtol=1e-9)
+        column = header_list.index(name)
+        for scheme, labels, table in tables:
+            values = [np.nan if value == None else value for value in sample['colors'][scheme].values()]
+            assert np.allclose(values, table[:,column], rtol=1e-9, atol=1e-9, equal_nan=True), (name, scheme)
+    connection.close()
+    
+    temp_dir = tempfile.mkdtemp(prefix='bench_')
+    shutil.copy(filenames[0], temp_dir)
+    old = best_of(lambda: run_spec(['-i', temp_dir, '-o', os.path.join(temp_dir, 'out.csv'), '--header',
+                                    '-s', '--window-length', '25', '--no-cache']), min(args.repeat, 5))
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    print '\nservice (one file per request, keep-alive connections)'
+    print "%-40s %9.2f ms" % ('spec.py run per file', old * 1000)
+    
+    requests = max(100, args.repeat * 20)
+    for clients in [1, 4, 16]:
+        latencies = []
+        def client(offset):
+            connection = httplib.HTTPConnection(host, port)
+            for count in range(offset, requests, clients):
+                name, text = texts[count % len(texts)]
+                start = time.time()
+                post(connection, name, text)
+                latencies.append(time.time() - start)
+            connection.close()
+        start = time.time()
+        threads = [threading.Thread(target=client, args=(offset,)) for offset in range(clients)]
+        for client_thread in threads: client_thread.start()
+        for client_thread in threads: client_thread.join()
+        elapsed = time.time() - start
+        latencies.sort()
+        print "%-40s %9.0f req/s   p50 %7.2f ms   p95 %7.2f ms   speedup %6.1fx" % \
+            ('%s client(s), %s requests' % (clients, requests), requests / elapsed,
+             latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.95)] * 1000,
+             old * requests / elapsed)
+    server.shutdown()
+    server.server_close()
+
+def bench_thumbs(args):
+    """Paged LineCollection exportThumbs vs. one subplot per spectrum in plotThumbs"""
+    import shutil
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    temp_dir = tempfile.mkdtemp(prefix='bench_')
+    print '\nthumbs'
+    for samples in [100, args.samples]:
+        nm, stack = spectrum_stack(samples, args.min_nm, args.max_nm)
+        data_set = np.vstack((nm, stack))
+        header_list = ['sample%05d' % count for count in range(samples)]
+        new = best_of(lambda: spec.exportThumbs(data_set, header_list, os.path.join(temp_dir, 'new.png')), 1)
+        if samples <= 100:
+            def legacy():
+                plotThumbs(data_set, header_list)
+                plt.savefig(os.path.join(temp_dir, 'old.png'))
+                plt.close('all')
+            old = best_of(legacy, 1)
+            report('%s spectra to png' % (samples), old, new)
+        else:
+            print "%-40s new %9.2f ms" % ('%s spectra to png' % (samples), new * 1000)
+        new = best_of(lambda: spec.exportThumbs(data_set, header_list, os.path.join(temp_dir, 'new.pdf')), 1)
+        print "%-40s new %9.2f ms" % ('%s spectra to pdf' % (samples), new * 1000)
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+# SYNTHETIC DIRECTORIES FOR THE SUITE, ONE PER FORMAT IN test_data
+FORMATS = [('spectrasuite', os.path.join('spec_format_versions', 'Chateaubrun_0005.txt'), True),
+           ('ooibase32', os.path.join('spec_format_versions', 'cej1.00060.Master.txt'), True),
+           ('headerless', os.path.join('testfiles_no_headers', 'CRL389_00.txt'), False)]
+
+VARIANTS = 32           # DISTINCT SPECTRA PER DIRECTORY, REPEATED TO THE REQUESTED SIZE
+MIN_BASELINE_SECONDS = 0.05 # STAGES FASTER THAN THIS ARE TOO NOISY TO FLAG
+
+def synthetic_variants(template, header, count, seed=0):
+    """Return count copies of the template file text with rescaled and jittered reflectances"""
+    text = open(os.path.join(TEST_DATA, template)).read()
+    head, tail = '', ''
+    if header == True:
+        start = text.find('\n', text.find('Begin')) + 1
+        stop = text.rfind('\n', start, text.find('End', start)) + 1
+        head, tail, text = text[:start], text[stop:], text[start:stop]
+    lines = text.splitlines()
+    nanometers = [line.split()[0] for line in lines]
+    reflectances = np.array([float(line.split()[1]) for line in lines])
+    
+    random = np.random.RandomState(seed)
+    variants = []
+    for number in range(count):
+        values = reflectances * random.uniform(0.8, 1.2) + random.normal(0, 0.5, len(reflectances))
+        body = ''.join(['%s\t%.3f\n' % (nm, value) for nm, value in zip(nanometers, values)])
+        variants.append(head + body + tail)
+    return variants
+
+def synthetic_directory(args, name, template, header, size):
+    """Write (or reuse) a directory of size synthetic spec files in the named format"""
+    path = os.path.join(args.data_dir, '%s_%d' % (name, size))
+    if os.path.isdir(path) and len(getFilenames(path)) == size:
+        return path
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    variants = synthetic_variants(template, header, min(size, VARIANTS))
+    for count in range(size):
+        fout = open(os.path.join(path, '%s_%06d.txt' % (name, count)), 'w')
+        fout.write(variants[count % len(variants)])
+        fout.close()
+    return path
+
+def time_spec(input_dir, header, args):
+    """Run spec.py on input_dir with --timing-json and return its timings"""
+    temp_dir = tempfile.mkdtemp(prefix='bench_')
+    timing = os.path.join(temp_dir, 'timing.json')
+    arguments = ['-i', input_dir, '-o', os.path.join(temp_dir, 'out.csv'), '--no-cache',
+                 '--min-nm', str(args.min_nm), '--max-nm', str(args.max_nm), '-s',
+                 '-j', str(args.jobs), '--timing-json', timing]
+    if header == True: arguments.append('--header')
+    run_spec(arguments)
+    results = json.load(open(timing), object_pairs_hook=collections.OrderedDict)
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    return results
+
+def compare_baseline(results, baseline, tolerance):
+    """Return a list of (key, stage, baseline seconds, seconds) that are slower than the baseline allows"""
+    slower = []
+    for key, result in sorted(results.items()):
+        if key not in baseline: continue
+        timings = [('wall', baseline[key]['wall_seconds'], result['wall_seconds'])]
+        for stage, entry in baseline[key]['stages'].items():
+            if stage in result['stages']:
+                timings.append((stage, entry['seconds'], result['stages'][stage]['seconds']))
+        for stage, old, new in timings:
+            if old >= MIN_BASELINE_SECONDS and new > old * (1 + tolerance):
+                slower.append((key, stage, old, new))
+    return slower
+
+def bench_suite(args):
+    """ Per-stage spec.py timings, throughput and peak memory on synthetic directories of each
+        format, plus the time a Coloration session takes for the same files in-process
+    """
+    sizes = [int(size) for size in args.sizes.split(',')]
+    formats = [f for f in FORMATS if f[0] in args.formats.split(',')]
+    print '\nsuite (%s-%s nm, smoothed, %s job(s))' % (args.min_nm, args.max_nm, args.jobs)
+    results = {}
+    for name, template, header in formats:
+        for size in sizes:
+            key = '%s_%d' % (name, size)
+            input_dir = synthetic_directory(args, name, template, header, size)
+            result = time_spec(input_dir, header, args)
+            
+            # THE SAME WORK IN-PROCESS THROUGH A Coloration SESSION
+            session = Coloration(args.min_nm, args.max_nm, 1.0, header, True)
+            start = time.time()
+            data_set, header_list, errors = session.processFiles(session.getFilenames(input_dir))
+            session.calcColorMeasurments(data_set)
+            result['stages']['session'] = {'calls': 1, 'seconds': time.time() - start, 'items': size}
+            results[key] = result
+            stages = result['stages']
+            wall = result['wall_seconds']
+            rows = stages.get('parse', {}).get('items', 0)
+            peak = max(result['peak_memory_mb'], result['peak_worker_memory_mb'])
+            print '%-26s %9.2f s   %9.0f files/s   %11.0f rows/s   peak %9s MB' % \
+                (key, wall, size / wall, rows / wall, 'n/a' if peak == None else '%.1f' % (peak))
+            print '    ' + '   '.join(['%s %.3f s' % (stage, entry['seconds']) for stage, entry in stages.items()])
+    
+    if args.save_baseline != None:
+        fout = open(args.save_baseline, 'w')
+        json.dump(results, fout, indent=1, sort_keys=True)
+        fout.close()
+        print 'saved baseline to %s' % (args.save_baseline)
+    
+    if args.baseline != None:
+        slower = compare_baseline(results, json.load(open(args.baseline)), args.tolerance)
+        for key, stage, old, new in slower:
+            print 'SLOWER: %s %s %.3f s -> %.3f s (%+.0f%%)' % (key, stage, old, new, 100 * (new / old - 1))
+        if len(slower) > 0: return False
+        print 'no stage is more than %.0f%% slower than %s' % (100 * args.tolerance, args.baseline)
+    return True
+
+def bench_readahead(args):
+    """spec.py with and without --read-ahead; point --data-dir at a network share to see the I/O overlap"""
+    size = max([int(size) for size in args.sizes.split(',')])
+    name, template, header = FORMATS[0]
+    input_dir = synthetic_directory(args, name, template, header, size)
+    print '\nread-ahead (%s %s files in %s)' % (size, name, args.data_dir)
+    for depth in [0, 4, 16]:
+        temp_dir = tempfile.mkdtemp(prefix='bench_')
+        arguments = ['-i', input_dir, '-o', os.path.join(temp_dir, 'out.csv'), '--no-cache', '-s',
+                     '-j', str(args.jobs), '--read-ahead', str(depth)]
+        elapsed = best_of(lambda: run_spec(arguments), args.repeat)
+        print "%-40s %9.2f ms   %9.0f files/s" % ('--read-ahead %s' % (depth), elapsed * 1000, size / elapsed)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+BENCHMARKS = [('parse', bench_parse),
+              ('interpolate', bench_interpolate),
+              ('smooth', bench_smooth),
+              ('normalize', bench_normalize),
+              ('colors', bench_colors),
+              ('spectra', bench_spectra),
+              ('stats', bench_stats),
+              ('qc', bench_qc),
+              ('classify', bench_classify),
+              ('startup', bench_startup),
+              ('thumbs', bench_thumbs),
+              ('service', bench_service),
+              ('suite', bench_suite),
+              ('readahead', bench_readahead)]
+
+def main():
+    args = get_args()
+    passed = True
+    for name, func in BENCHMARKS:
+        if name in args.benchmark or 'all' in args.benchmark:
+            if func(args) == False: passed = False
+    if not passed: sys.exit(1)
+
+if __name__ == '__main__':
+
+    try: main()
+    except KeyboardInterrupt: sys.exit(1) # makes clean control-C exit
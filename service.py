@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+service.py
+
+A long-running local HTTP service around a Coloration session, so other tools can
+measure spectra without paying the Python, numpy and scipy startup of spec.py on
+every call. Spectra from requests that arrive together are interpolated, smoothed
+and measured in one batch.
+
+Example:
+
+python service.py --port 8642 -s --window-length 25
+
+# ONE FILE AS THE REQUEST BODY
+curl --data-binary @test_data/testfiles_with_headers/dorsal011.txt 'http://127.0.0.1:8642/measure?name=dorsal011.txt'
+
+# SEVERAL FILES OR RAW ARRAYS AS JSON
+curl -H 'Content-Type: application/json' -d '{"spectra": [{"name": "a", "nanometers": [...], "reflectances": [...]}]}' \
+http://127.0.0.1:8642/measure
+
+Responses are JSON: the nanometers of the session grid and, for every sample, its
+name, interpolated reflectances and the measurments of each color scheme. Samples
+that could not be processed are listed under errors.
+
+"""
+
+import sys
+import time
+import json
+import Queue
+import urlparse
+import argparse
+import threading
+import collections
+import SocketServer
+import BaseHTTPServer
+import numpy as np
+
+from Coloration import Coloration, SpectrumSet, READERS, splitColors
+
+# LARGEST REQUEST BODY ACCEPTED
+MAX_BODY_BYTES = 64 * 2**20
+
+def get_args():
+    """Parse sys.argv"""
+    parser = argparse.ArgumentParser(prog='service.py',
+        description='Serve interpolated spectra and color measurments as JSON over HTTP.')
+
+    parser.add_argument('--host', default='127.0.0.1',
+        help='Address to listen on. Default is 127.0.0.1 (this machine only).')
+
+    parser.add_argument('--port', type=int, default=8642,
+        help='Port to listen on. Default is 8642.')
+
+    parser.add_argument('--batch-size', type=int, default=256,
+        help='Most spectra measured in one batch. Default is 256.')
+
+    parser.add_argument('--batch-wait', type=float, default=2.0,
+        help='Milliseconds to wait for more requests to join a batch. Default is 2.')
+
+    parser.add_argument('--header', action='store_true',
+        help='Skip headers of files whose format is not recognized.')
+
+    parser.add_argument('--schemes', metavar='FILE',
+        help='JSON file of color schemes to measure (see color_schemes.json). Default is the Macedonia and Endler schemes.')
+
+    parser.add_argument('--dark', metavar='FILE',
+        help='Dark spectrum to subtract from every spectrum before interpolating (raw counts).')
+
+    parser.add_argument('--white', metavar='FILE',
+        help='White reference spectrum; spectra are divided by it (after dark subtraction) to give percent reflectance.')
+
+    parser.add_argument('--clip', type=float, nargs=2, metavar=('LOWER', 'UPPER'),
+        help='Clip values to LOWER-UPPER (e.g. 0 100) before interpolating.')
+
+    parser.add_argument('--format', choices=['auto'] + READERS.keys(), default='auto',
+        help='File format of uploaded files. Default is auto.')
+
+    parser.add_argument('--min-nm', type=int, default=300,
+        help='Lowest nm to include. Default is 300 nm.')
+
+    parser.add_argument('--max-nm', type=int, default=700,
+        help='Highest nm to include. Default is 700 nm.')
+
+    parser.add_argument('--intrp', type=float, default=1.0,
+        help='Interpolate nm increments. Default is 1 nm.')
+
+    parser.add_argument('-s', '--smooth', action='store_true',
+        help='Add smoothing function. Default is a 100 nm hanning window.')
+
+    parser.add_argument('--window-type', choices=['flat','hanning','hamming','bartlett','blackman'], default='hanning',
+        help='Define window smoothing type.')
+
+    parser.add_argument('--window-length', type=int, default=100,
+        help='Window size for smoothing. Longer is more aggressive. Default is 100.')
+
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help='Log every request and batch to STDERR.')
+
+    return parser.parse_args()
+
+def jsonFloats(values):
+    """Return values as a list of floats with nan and inf as None, which JSON can hold"""
+    values = np.asarray(values, dtype=float)
+    finite = np.isfinite(values)
+    if finite.all():
+        return values.tolist()
+    return [value if keep else None for value, keep in zip(values.tolist(), finite)]
+
+class Batcher(object):
+    """ Owns the Coloration session and measures the spectra of every request waiting in its
+        queue together: one thread takes the first waiting request, collects whatever else
+        arrives within batch_wait seconds (up to batch_size spectra) and runs them through
+        Coloration.processSpectra and measure in one call before answering each request.
+    """
+    def __init__(self, session, batch_size=256, batch_wait=0.002, verbose=False):
+        super(Batcher, self).__init__()
+        self.session = session
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.verbose = verbose
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, spectra, names):
+        """ Queue raw (nanometers, reflectances) spectra named names and wait for their batch.
+            Returns (SpectrumSet, stacked colors, errors) as measureBatch gives them.
+        """
+        job = {'spectra': spectra, 'names': names, 'done': threading.Event(), 'result': None}
+        self.queue.put(job)
+        job['done'].wait()
+        if isinstance(job['result'], Exception):
+            raise job['result']
+        return job['result']
+
+    def stop(self):
+        """Finish the waiting requests and end the batching thread"""
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job == None: return
+            jobs = [job]
+            count = len(job['spectra'])
+            deadline = time.time() + self.batch_wait
+            while count < self.batch_size:
+                try: job = self.queue.get(True, max(0, deadline - time.time()))
+                except Queue.Empty: break
+                if job == None:
+                    self.queue.put(None)
+                    break
+                jobs.append(job)
+                count += len(job['spectra'])
+
+            start = time.time()
+            try:
+                self.measureBatch(jobs)
+            except Exception, e:
+                for job in jobs: job['result'] = e
+            if self.verbose:
+                sys.stderr.write('batch of %s requests, %s spectra in %.1f ms\n' % \
+                                 (len(jobs), count, (time.time() - start) * 1000))
+            for job in jobs:
+                job['done'].set()
+
+    def measureBatch(self, jobs):
+        """Process and measure the spectra of jobs together and give each job its share"""
+        spectra = []
+        names = []
+        owners = []
+        for count, job in enumerate(jobs):
+            spectra.extend(job['spectra'])
+            names.extend(job['names'])
+            owners.extend([count] * len(job['spectra']))
+
+        # NAMES ARE TAGGED WITH THEIR POSITION SO REPEATED NAMES STAY APART
+        processed, failures = self.session.processSpectra(spectra, range(len(names)))
+        colors = self.session.measure(processed)
+
+        # EACH JOB'S SPECTRA ARE ONE RUN OF THE BATCH, SO ITS SHARE IS A VIEW
+        kept_owners = np.array([owners[tag] for tag in processed.names], dtype=int)
+        for count, job in enumerate(jobs):
+            start, end = np.searchsorted(kept_owners, [count, count + 1])
+            job_spectra = SpectrumSet(processed.nanometers, processed.reflectances[start:end],
+                                      [names[tag] for tag in processed.names[start:end]])
+            errors = [(names[tag], error) for tag, error in failures if owners[tag] == count]
+            job['result'] = (job_spectra, colors[:,start:end], errors)
+
+class ServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ GET /health returns the session settings. POST /measure takes one file as the body
+        (its name from ?name=) or JSON {"files": [{"name", "text"}], "spectra": [{"name",
+        "nanometers", "reflectances"}]} and returns the processed spectra and their colors.
+    """
+    server_version = 'Coloration/beta'
+    protocol_version = 'HTTP/1.1'
+    # SEND EACH RESPONSE IN ONE WRITE WITHOUT WAITING ON NAGLE'S ALGORITHM AND DELAYED ACKS
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def sendJSON(self, status, body):
+        text = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def do_GET(self):
+        session = self.server.session
+        if urlparse.urlparse(self.path).path != '/health':
+            return self.sendJSON(404, {'error': 'Unknown path %s' % (self.path)})
+        self.sendJSON(200, {'status': 'ok',
+                            'min_nm': session.min_nm, 'max_nm': session.max_nm, 'intrp': session.intrp,
+                            'smooth': session.smooth_spectra, 'window_type': session.window_type,
+                            'window_length': session.window_length, 'format': session.format,
+                            'schemes': [scheme['name'] for scheme in session.schemes]})
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != '/measure':
+            return self.sendJSON(404, {'error': 'Unknown path %s' % (self.path)})
+        try:
+            length = int(self.headers.getheader('Content-Length') or 0)
+        except ValueError:
+            self.close_connection = 1
+            return self.sendJSON(400, {'error': 'Content-Length is not a number.'})
+        if length < 0:
+            self.close_connection = 1
+            return self.sendJSON(400, {'error': 'Content-Length is negative.'})
+        if length > MAX_BODY_BYTES:
+            self.close_connection = 1
+            return self.sendJSON(413, {'error': 'Request body is over %s bytes.' % (MAX_BODY_BYTES)})
+        body = self.rfile.read(length)
+        try:
+            spectra, names, errors = self.readSpectra(body, url)
+        except (ValueError, TypeError, KeyError, AttributeError), e:
+            return self.sendJSON(400, {'error': '%s: %s' % (e.__class__.__name__, e)})
+
+        try:
+            processed, colors, failures = self.server.batcher.submit(spectra, names)
+        except Exception, e:
+            return self.sendJSON(500, {'error': '%s: %s' % (e.__class__.__name__, e)})
+        tables = splitColors(colors, self.server.session.schemes)
+        samples = []
+        for count, name in enumerate(processed.names):
+            measurments = collections.OrderedDict()
+            for scheme, labels, table in tables:
+                measurments[scheme] = collections.OrderedDict(zip(labels, jsonFloats(table[:,count])))
+            samples.append(collections.OrderedDict([('name', name),
+                                                    ('reflectances', jsonFloats(processed.reflectances[count])),
+                                                    ('colors', measurments)]))
+        errors.extend(failures)
+        self.sendJSON(200, collections.OrderedDict([('nanometers', jsonFloats(processed.nanometers)),
+                                                    ('samples', samples),
+                                                    ('errors', [{'name': name, 'error': error} for name, error in errors])]))
+
+    def readSpectra(self, body, url):
+        """ Return the raw (nanometers, reflectances) spectra of a request inside the session
+            range, their names and the (name, error) of files that could not be parsed
+        """
+        session = self.server.session
+        content_type = (self.headers.getheader('Content-Type') or '').split(';')[0].strip()
+        if content_type == 'application/json':
+            request = json.loads(body)
+            if not isinstance(request, dict):
+                raise ValueError, 'The JSON body must be an object with "files" and/or "spectra" lists.'
+            files = request.get('files', [])
+            arrays = request.get('spectra', [])
+        else:
+            name = urlparse.parse_qs(url.query).get('name', ['sample'])[0]
+            files = [{'name': name, 'text': body}]
+            arrays = []
+
+        spectra = []
+        names = []
+        errors = []
+        for count, item in enumerate(files):
+            name = item.get('name', 'file%d' % (count))
+            try:
+                nanometers, reflectances, metadata = session.parseSpectrum(str(item['text']))
+                if nanometers.size <= 3:
+                    raise ValueError, "Not enough spectral data between %s and %s nm." % (session.min_nm, session.max_nm)
+            except Exception, e:
+                errors.append((name, '%s: %s' % (e.__class__.__name__, e)))
+                continue
+            spectra.append((nanometers, reflectances))
+            names.append(name)
+        for count, item in enumerate(arrays):
+            nanometers = np.array(item['nanometers'], dtype=float)
+            reflectances = np.array(item['reflectances'], dtype=float)
+            if nanometers.ndim != 1 or nanometers.shape != reflectances.shape:
+                raise ValueError, "nanometers and reflectances of spectrum %d are not two lists of one length." % (count)
+            spectra.append(session.windowSpectrum(nanometers, reflectances))
+            names.append(item.get('name', 'spectrum%d' % (count)))
+        return (spectra, names, errors)
+
+class ServiceServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A threaded HTTP server whose handlers share one session through a Batcher"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, session, batch_size=256, batch_wait=0.002, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ServiceHandler)
+        self.session = session
+        self.verbose = verbose
+        self.batcher = Batcher(session, batch_size, batch_wait, verbose)
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        self.batcher.stop()
+
+def main():
+    args = get_args()
+    try:
+        session = Coloration.fromArgs(args)
+    except (IOError, OSError, ValueError), e:
+        sys.stderr.write('%s\n' % (e))
+        sys.exit(1)
+    server = ServiceServer((args.host, args.port), session, args.batch_size, args.batch_wait / 1000.0, args.verbose)
+    sys.stderr.write('Serving on http://%s:%s/measure\n' % server.server_address)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+
+    try: main()
+    except KeyboardInterrupt: sys.exit(1) # makes clean control-C exit
@@ -18,14 +18,26 @@ python spec.py -i test_data/testfiles_with_headers/ \
 """
 
 import os
+import re
 import sys
-import glob
+import time
+import json
+import hashlib
+import shutil
 import argparse
+import tempfile
+import collections
 import itertools
-import jellyfish
-from pylab import *
-from scipy import interpolate
-from Coloration import Coloration
+import multiprocessing
+import numpy as np
+
+# THE PROCESSING ENGINE LIVES IN Coloration.py
+from Coloration import Coloration, timer, getFilenames, saveCSV, READERS, METADATA_FIELDS, parseSpectrum, \
+    loadSpectrum, readMetadata, SpectrumSet, spectrumArrays, filePrefix, GroupedStats, saveStats, \
+    SPIKE_THRESHOLD, QC_CHECKS, screenSpectra, PLOT_BANDS, plotMean, plotThumbs
+
+# matplotlib IS IMPORTED INSIDE THE FUNCTIONS THAT USE IT SO THAT
+# PLAIN CSV CONVERSIONS DO NOT PAY FOR LOADING IT
 
 def get_args():
     """Parse sys.argv"""
@@ -39,8 +51,38 @@ def get_args():
         help='A csv file to contain the merged specs suitable for opening in excel.')
     
     parser.add_argument('--header', action='store_true', 
-        help='Setting this flag will skip headers.')
+        help='Setting this flag will skip headers. Only needed for files whose format is not recognized.')
+
+    parser.add_argument('--schemes', metavar='FILE', 
+        help='JSON file of color schemes to measure (see color_schemes.json). Default is the Macedonia and Endler schemes.')
+
+    parser.add_argument('--dark', metavar='FILE', 
+        help='Dark spectrum to subtract from every file before interpolating (raw count files).')
+
+    parser.add_argument('--white', metavar='FILE', 
+        help='White reference spectrum; files are divided by it (after dark subtraction) to give percent reflectance.')
+
+    parser.add_argument('--clip', type=float, nargs=2, metavar=('LOWER', 'UPPER'), 
+        help='Clip values to LOWER-UPPER (e.g. 0 100) before interpolating.')
+
+    parser.add_argument('--format', choices=['auto'] + READERS.keys(), default='auto', 
+        help='File format. Default is auto, which detects the format of each file from its first bytes.')
+
+    parser.add_argument('--metadata', metavar='FILE', 
+        help='Write the format, integration time, spectra averaged, boxcar smoothing and serial number of every file to FILE as CSV.')
     
+    parser.add_argument('--qc', metavar='FILE', 
+        help='Screen every interpolated spectrum for spikes, saturation, flat lines and NaN/Inf colors and write a per-file report to FILE as CSV.')
+
+    parser.add_argument('--qc-exclude', action='store_true', 
+        help='Leave files that fail screening out of the output, color tables and --stats.')
+
+    parser.add_argument('--spike-threshold', type=float, default=SPIKE_THRESHOLD, 
+        help='How many local median absolute deviations off the rolling median mark a spike. Default is %s.' % (SPIKE_THRESHOLD))
+
+    parser.add_argument('--saturation', type=float, metavar='LEVEL', 
+        help='Also flag as saturated any spectrum reaching LEVEL (e.g. the full-scale count of raw files).')
+
     parser.add_argument('--min-nm', type=int, default=300, 
         help='Lowest nm to include. Default is 300 nm.')
     
@@ -53,7 +95,7 @@ def get_args():
     parser.add_argument('-s', '--smooth', action='store_true', 
         help='Add smoothing function. Default is a 100 nm hanning window.')
     
-    parser.add_argument('--window-type', type=complex, choices=['flat','hanning','hamming','bartlett','blackman'],
+    parser.add_argument('--window-type', choices=['flat','hanning','hamming','bartlett','blackman'],
         help= 'Define window smoothing type.')
 
     parser.add_argument('--window-length', type=int, default=100, 
@@ -62,8 +104,32 @@ def get_args():
     parser.add_argument('-p','--plot', action='store_true', 
         help='Produce interactive plots with matplotlib.')
 
-    parser.add_argument('-v','-verbose', action='store_true', 
-        help='Write verbose output (non functional).')
+    parser.add_argument('--plot-band', choices=PLOT_BANDS, default='var', 
+        help='Shade the mean plot by the variance, standard deviation, standard error or confidence band. Default is var.')
+
+    parser.add_argument('--stats', metavar='FILE', 
+        help='Write the count, mean, std, standard error and confidence band of each group at every nanometer to FILE as CSV, computed in one streaming pass.')
+
+    parser.add_argument('--stats-by', choices=['all', 'prefix', 'tissue'], default='all', 
+        help='Group --stats by file prefix (the name before the first _ less trailing digits), by dewlap/dorsal/ventral tissue, or not at all. Default is all.')
+
+    parser.add_argument('--confidence', type=float, default=0.95, 
+        help='Level of the confidence bands of --stats and --plot-band ci. Default is 0.95.')
+
+    parser.add_argument('--thumbs', metavar='PATH', 
+        help='Save every spectrum as a thumbnail on paged grids without a display. A .pdf PATH gives one multi-page file, other extensions (e.g. .png) one numbered file per page.')
+    
+    parser.add_argument('--thumbs-per-page', type=int, default=100, 
+        help='Number of thumbnails on each page of --thumbs output. Default is 100.')
+    
+    parser.add_argument('-v','-verbose','--verbose', dest='verbose', action='store_true', 
+        help='Print wall time, call counts and throughput of each pipeline stage and peak memory to STDERR.')
+
+    parser.add_argument('--timing-json', metavar='FILE', 
+        help='Write the per-stage timings as JSON to FILE.')
+
+    parser.add_argument('--profile', metavar='FILE', 
+        help='Run under cProfile and save the stats to FILE (read with pstats).')
 
     parser.add_argument('--version', action='version', version='%(prog)s beta', 
         help='Print version.')
@@ -71,6 +137,36 @@ def get_args():
     parser.add_argument("--DDV",action='store_true', 
         help="process files based on dewlap/dorsal/ventral in filename")
     
+    parser.add_argument('-j', '--jobs', type=int, default=1, 
+        help='Number of worker processes used to parse, interpolate and smooth files. Default is 1.')
+    
+    parser.add_argument('--chunk-size', type=int, default=0, 
+        help='Stream the directory in chunks of this many files, writing the CSV as it goes. Default is 0 (load everything).')
+    
+    parser.add_argument('--read-ahead', type=int, default=0, 
+        help='Read up to this many files ahead with a pool of threads while earlier files are processed; helps on slow network shares. Default is 0 (read each file when it is parsed).')
+    
+    parser.add_argument('--output-format', choices=['csv','binary','both'], default='csv', 
+        help='Write the merged specs as csv, as a binary matrix (.dat) with a .json sidecar, or both. Default is csv.')
+    
+    parser.add_argument('--output-dtype', choices=['float32','float64'], default='float32', 
+        help='Value type of binary output. Default is float32.')
+    
+    parser.add_argument('--append', action='store_true', 
+        help='Append samples to existing binary output instead of overwriting it.')
+    
+    parser.add_argument('--watch', type=float, metavar='SECONDS', 
+        help='Keep running and check the input directory every SECONDS for new or changed files, updating the output in place.')
+    
+    parser.add_argument('--cache-dir', 
+        help='Directory for cached interpolated spectra. Default is .spec_cache in the input directory.')
+    
+    parser.add_argument('--cache-size', type=float, default=256, 
+        help='Largest size of the cache in MB before the least recently used entries are evicted. It is checked every %s stored files and at the end of a run, so the cache can briefly grow past it. Only cache entries are ever deleted. Default is 256.' % (CACHE_PRUNE_EVERY))
+    
+    parser.add_argument('--no-cache', action='store_true', 
+        help='Always parse and interpolate the text files, without reading or writing the cache.')
+    
     args = parser.parse_args()
     
     # CHECK ARGUEMENTS FOR ERRORS
@@ -82,296 +178,937 @@ def get_args():
         print "\n\t\t\tWARNING: Overwriting existing output at %s\n" % (args.output_file)
     
     if args.window_type == None: args.window_type = 'hanning'
+    if args.jobs < 1: args.jobs = multiprocessing.cpu_count()
+    if args.no_cache: args.cache_dir = None
+    elif args.cache_dir == None: args.cache_dir = os.path.join(args.input_dir, '.spec_cache')
     return args
 
-def getFilenames(path2dir):
-    """Parse file names in directory"""
-    txt = glob.glob(os.path.join(path2dir, '*.txt'))
-    b = glob.glob(os.path.join(path2dir, '*.b'))
-    trans = glob.glob(os.path.join(path2dir, '*.transmission'))
-    filenames = trans + txt + b
-    return filenames
+def binaryPaths(fout):
+    """Return the (matrix, sidecar) paths of binary output named after fout"""
+    root = os.path.splitext(fout)[0]
+    return (root + '.dat', root + '.json')
 
-def smooth(x,window_len=11,window='hanning'):
-    """smooth the data using a window with requested size.
+def writeSidecar(path, sidecar):
+    """Replace a binary output sidecar in one step so readers never see half of it"""
+    temp = path + '.tmp'
+    fout = open(temp,'w')
+    json.dump(sidecar, fout)
+    fout.close()
+    os.rename(temp, path)
 
-    This method is based on the convolution of a scaled window with the signal.
-    The signal is prepared by introducing reflected copies of the signal 
-    (with the window size) in both ends so that transient parts are minimized
-    in the begining and end part of the output signal.
+def saveBinary(data_set, column_names, fout, dtype='float32'):
+    """ Save files as a raw (samples x nanometers) matrix that can be memory-mapped, plus a
+        json sidecar holding the dtype, shape, nanometer axis and sample names.
+    """
+    matrix_path, sidecar_path = binaryPaths(fout)
+    nanometers, reflectances = spectrumArrays(data_set)
+    data = np.ascontiguousarray(reflectances, dtype=dtype)
+    data.tofile(matrix_path)
+    sidecar = {'dtype': np.dtype(dtype).name,
+               'shape': list(data.shape),
+               'nanometers': [float(nm) for nm in nanometers],
+               'samples': list(column_names)}
+    writeSidecar(sidecar_path, sidecar)
 
-    input:
-        x: the input signal 
-        window_len: the dimension of the smoothing window; should be an odd integer
-        window: the type of window from 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'
-            flat window will produce a moving average smoothing.
+def appendBinary(data_set, column_names, fout):
+    """ Add samples to the end of existing binary output without rewriting what is already
+        there. The nanometer axis must match. Creates the output if it does not exist.
+    """
+    matrix_path, sidecar_path = binaryPaths(fout)
+    if not os.path.exists(sidecar_path):
+        return saveBinary(data_set, column_names, fout)
+    sidecar = json.load(open(sidecar_path))
+    nanometers, reflectances = spectrumArrays(data_set)
+    if len(sidecar['nanometers']) != len(nanometers) or \
+            not np.allclose(sidecar['nanometers'], nanometers):
+        raise ValueError, "Nanometers of %s do not match the samples being appended." % (matrix_path)
+    
+    data = np.ascontiguousarray(reflectances, dtype=sidecar['dtype'])
+    fout = open(matrix_path,'ab')
+    # DROP ANY ROWS PAST THE SIDECAR LEFT BY AN INTERRUPTED APPEND
+    fout.truncate(sidecar['shape'][0] * data.shape[1] * data.itemsize)
+    fout.seek(0, os.SEEK_END)
+    data.tofile(fout)
+    fout.close()
+    sidecar['shape'][0] += data.shape[0]
+    sidecar['samples'].extend(column_names)
+    writeSidecar(sidecar_path, sidecar)
 
-    output:
-        the smoothed signal
+def openBinary(fout, mode='r'):
+    """ Memory-map binary output written by saveBinary. Returns (reflectances, nanometers,
+        sample names) where reflectances is a (samples x nanometers) np.memmap.
+    """
+    matrix_path, sidecar_path = binaryPaths(fout)
+    sidecar = json.load(open(sidecar_path))
+    shape = tuple(sidecar['shape'])
+    if shape[0] == 0:
+        reflectances = np.zeros(shape, dtype=sidecar['dtype'])
+    else:
+        reflectances = np.memmap(matrix_path, dtype=sidecar['dtype'], mode=mode, shape=shape)
+    return (reflectances, np.array(sidecar['nanometers']), sidecar['samples'])
 
-    example:
+def saveOutput(data_set, column_names, args, append=False):
+    """Write data_set in the formats chosen by --output-format"""
+    if args.output_format in ['csv', 'both']:
+        saveCSV(data_set, column_names, args.output_file)
+    if args.output_format in ['binary', 'both']:
+        if append or args.append: appendBinary(data_set, column_names, args.output_file)
+        else: saveBinary(data_set, column_names, args.output_file, args.output_dtype)
 
-    t=linspace(-2,2,0.1)
-    x=sin(t)+randn(len(t))*0.1
-    y=smooth(x)
+def saveMetadata(column_names, metadata, fout):
+    """Save the metadata dicts of the named files as a table with one row per file"""
+    fout = open(fout,'w')
+    fout.write('file,' + ','.join(METADATA_FIELDS) + '\n')
+    for name, fields in zip(column_names, metadata):
+        values = [fields.get(key) for key in METADATA_FIELDS]
+        fout.write(name + ',' + ','.join(['' if value == None else str(value) for value in values]) + '\n')
+    fout.close()
 
-    see also: 
+# COLUMNS OF THE --qc REPORT
+QC_FIELDS = ['passed', 'problems'] + QC_CHECKS[:1] + ['spike_nm'] + QC_CHECKS[1:]
 
-    np.hanning, np.hamming, np.bartlett, np.blackman, np.convolve
-    scipy.signal.lfilter
+def qcRecords(names, flags):
+    """ Turn the screenSpectra results of the named spectra into (name, fields) report rows.
+        Returns (records, failed) where failed marks the spectra with any problem.
+    """
+    failed = np.zeros(len(names), dtype=bool)
+    for check in QC_CHECKS:
+        failed |= flags[check]
+    records = []
+    for count, name in enumerate(names):
+        problems = [check for check in QC_CHECKS if flags[check][count]]
+        if flags['spike'][count]:
+            problems[0] = 'spike at %g nm' % (flags['spike_nm'][count])
+        fields = dict([(check, bool(flags[check][count])) for check in QC_CHECKS])
+        fields.update({'passed': not failed[count], 'problems': '; '.join(problems),
+                       'spike_nm': flags['spike_nm'][count] if flags['spike'][count] else None})
+        records.append((name, fields))
+    return (records, failed)
+
+def saveQC(records, fout):
+    """Save the (name, fields) rows of qcRecords as a table with one row per file"""
+    fout = open(fout,'w')
+    fout.write('file,' + ','.join(QC_FIELDS) + '\n')
+    for name, fields in records:
+        values = [fields.get(key) for key in QC_FIELDS]
+        fout.write(name + ',' + ','.join(['' if value == None else str(value) for value in values]) + '\n')
+    fout.close()
 
-    TODO: the window parameter could be the window itself if an array instead of a string   
+def readFile(task):
+    """ Read the raw spectrum of a single file. Takes a (filename, args, text) tuple, where text
+        is the file already read by readAhead or None, and returns (filename, result, error)
+        where result is (nanometers, reflectances, basename, metadata) or None if the file
+        could not be read.
     """
+    filename, args, text = task
+    try:
+        if text == None:
+            nanometers, reflectances, metadata = loadSpectrum(filename, args.min_nm, args.max_nm, args.header, args.format)
+        else:
+            nanometers, reflectances, metadata = parseSpectrum(text, float(args.min_nm), float(args.max_nm) + 1.0, \
+                                                               args.header, args.format)
+        if nanometers.size <= 3:
+            raise ValueError, "Not enough spectral data between %s and %s nm." % (args.min_nm, args.max_nm)
+        return (filename, (nanometers, reflectances, os.path.basename(filename), metadata), None)
+    except Exception, e:
+        return (filename, None, '%s: %s' % (e.__class__.__name__, e))
 
-    if x.ndim != 1:
-        raise ValueError, "smooth only accepts 1 dimension arrays."
+def referenceSignature(filename):
+    """Identify a --dark or --white file (or None) in cache keys so editing it invalidates the cache"""
+    if filename == None: return None
+    stat = os.stat(filename)
+    return (os.path.abspath(filename), stat.st_mtime, stat.st_size)
 
-    if x.size < window_len:
-        raise ValueError, "Input vector needs to be bigger than window size."
+def cacheKey(filename, args):
+    """ Return the cache key of a file: a hash of its path, modification time and size and
+        of the settings that change its interpolated spectrum.
+    """
+    stat = os.stat(filename)
+    key = repr((os.path.abspath(filename), stat.st_mtime, stat.st_size, \
+                float(args.min_nm), float(args.max_nm), float(args.intrp), bool(args.header), args.format, \
+                referenceSignature(args.dark), referenceSignature(args.white), args.clip))
+    return hashlib.md5(key).hexdigest()
 
-    if window_len<3:
-        return x
+def loadCached(cache_dir, key):
+    """Return the cached interpolated reflectances stored under key, or None"""
+    path = os.path.join(cache_dir, key + '.npy')
+    try:
+        reflectances = np.load(path)
+        os.utime(path, None) # MARK AS RECENTLY USED FOR pruneCache
+        return reflectances
+    except (IOError, OSError, ValueError):
+        return None
 
-    if window not in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
-        raise ValueError, "Window is on of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'"
+# CACHE ENTRIES ARE <md5 key>.npy; storeCached WRITES THEM THROUGH spec_*.tmp FILES
+CACHE_ENTRY = re.compile(r'^[0-9a-f]{32}\.npy$')
+CACHE_TEMP = re.compile(r'^spec_.*\.tmp$')
 
-    s=np.r_[2*x[0]-x[window_len-1::-1],x,2*x[-1]-x[-1:-window_len:-1]]
+# SECONDS AFTER WHICH A LEFTOVER TEMPORARY FILE IS TAKEN TO BE FROM AN INTERRUPTED WRITE
+CACHE_TEMP_AGE = 3600
 
-    if window == 'flat': #moving average
-        w=np.ones(window_len,'d')
-    else:
-        w=eval('np.'+window+'(window_len)')
-
-    y=np.convolve(w/w.sum(),s,mode='same')
-    return y[window_len:-window_len+1]
-
-def calcColorMeasurments(data_array):
-    """Print Liam's color measurments to SDOUT"""        
-    Macedonia_values = []
-    Endler_values = []
-    data_array = data_array.transpose()
-    for author in ['Macedonia', 'Endler']:
-        # CREATE SLICE INDICES
-        if author == 'Macedonia': Qt = (data_array[:,0] >= 325) & (data_array[:,0] <= 700)
-        else: Qt = (data_array[:,0] >= 400) & (data_array[:,0] <= 700)
-        U = (data_array[:,0] >= 325) & (data_array[:,0] < 400)
-        B = (data_array[:,0] >= 400) & (data_array[:,0] < 475)
-        G = (data_array[:,0] >= 475) & (data_array[:,0] < 550)
-        Y = (data_array[:,0] >= 550) & (data_array[:,0] < 625)
-        R = (data_array[:,0] >= 625) & (data_array[:,0] <= 700) 
-        
-        # DO BASIC CALCULATIONS
-        B = data_array[:,1:].compress(B,0).sum(0) / data_array[:,1:].compress(Qt,0).sum(0)
-        G = data_array[:,1:].compress(G,0).sum(0) / data_array[:,1:].compress(Qt,0).sum(0)
-        Y = data_array[:,1:].compress(Y,0).sum(0) / data_array[:,1:].compress(Qt,0).sum(0)
-        R = data_array[:,1:].compress(R,0).sum(0) / data_array[:,1:].compress(Qt,0).sum(0)
-        if author == 'Macedonia': U = data_array[:,1:].compress(U,0).sum(0) / data_array[:,1:].compress(Qt,0).sum(0)
-        else: U = np.zeros(data_array[:,1:].shape[-1])
-        Qt = data_array[:,1:].compress(Qt,0).sum(0)
-        
-        # CALCULATE MU, MS, LM, C, AND H
-        if author == 'Macedonia': MU = G-U
-        else: MU = np.zeros(data_array[:,1:].shape[-1])
-        MS = Y-B
-        LM = R-G
-        if author == 'Macedonia': C = np.sqrt(pow(LM,2)+pow(MS,2)+pow(MU,2))
-        else: C = np.sqrt(pow(LM,2)+pow(MS,2))
-        H = np.degrees(np.arccos(LM/C))
-        if author == 'Macedonia': 
-            Macedonia_values = [U,B,G,Y,R,Qt,MU,MS,LM,C,H]
-        else: 
-            Endler_values = [U,B,G,Y,R,Qt,MU,MS,LM,C,H]
-            
-    results = np.array([Macedonia_values, Endler_values])    
-    return results
-        
-def printCSV(data_set, column_names, row_names):
-    """Print files as table"""
+# NUMBER OF STORES BETWEEN THE PRUNES A PROCESS MAKES DURING A RUN
+CACHE_PRUNE_EVERY = 1000
+_stores_since_prune = [0]
+
+def storeCached(cache_dir, key, reflectances, max_bytes=None):
+    """ Write interpolated reflectances to the cache; failures only mean a later cache miss.
+        With max_bytes the cache is pruned every CACHE_PRUNE_EVERY stores, so a long run does
+        not grow it far past its limit.
+    """
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, temp = tempfile.mkstemp(prefix='spec_', suffix='.tmp', dir=cache_dir)
+        fout = os.fdopen(fd, 'wb')
+        np.save(fout, np.asarray(reflectances))
+        fout.close()
+        os.rename(temp, os.path.join(cache_dir, key + '.npy'))
+    except (IOError, OSError):
+        pass
+    _stores_since_prune[0] += 1
+    if max_bytes != None and _stores_since_prune[0] >= CACHE_PRUNE_EVERY:
+        _stores_since_prune[0] = 0
+        pruneCache(cache_dir, max_bytes)
+
+def pruneCache(cache_dir, max_bytes):
+    """ Delete the least recently used cache entries until the cache is under max_bytes, and
+        temporary files left by interrupted writes. Only the <md5 key>.npy and spec_*.tmp files
+        storeCached writes are touched; anything else in cache_dir is left alone.
+    """
+    if cache_dir == None or not os.path.isdir(cache_dir):
+        return
+    entries = []
+    now = time.time()
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+            if CACHE_TEMP.match(name):
+                if now - stat.st_mtime > CACHE_TEMP_AGE: os.remove(path)
+                continue
+        except OSError:
+            continue
+        if CACHE_ENTRY.match(name):
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum([size for mtime, size, path in entries])
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes: break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+def readText(task):
+    """ Read the whole text of a file for readAhead. Takes a (filename, args) tuple and returns
+        None for files that are already cached or cannot be read, which the chunk then handles
+        as if there were no read-ahead.
+    """
+    filename, args = task
+    try:
+        if args.cache_dir != None and os.path.exists(os.path.join(args.cache_dir, cacheKey(filename, args) + '.npy')):
+            return None
+        fin = open(filename,'r')
+        text = fin.read()
+        fin.close()
+        return text
+    except (IOError, OSError):
+        return None
+
+def readAhead(filenames, args, depth):
+    """ Yield readText results for filenames in order while a pool of depth threads keeps
+        reading up to depth files ahead of the one being consumed.
+    """
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(depth)
+    pending = collections.deque()
+    try:
+        for filename in filenames:
+            pending.append(pool.apply_async(readText, ((filename, args),)))
+            if len(pending) > depth:
+                # TIME SPENT WAITING FOR THE DISK OR NETWORK
+                with timer.stage('read wait'):
+                    text = pending.popleft().get(sys.maxint)
+                yield text
+        while pending:
+            with timer.stage('read wait'):
+                text = pending.popleft().get(sys.maxint)
+            yield text
+    finally:
+        pool.terminate()
+        pool.join()
+
+def processChunk(task):
+    """ Read a (filenames, args, texts) chunk of files, interpolate and smooth them together
+        through a Coloration session and return (nanometers, reflectances, header_list, errors,
+        metadata, qc). texts holds the files already read by readAhead, or is None. Files already
+        in args.cache_dir are loaded from there instead of being parsed; their metadata is read
+        from the header alone when --metadata asks for it. With --qc or --qc-exclude the
+        interpolated chunk is screened before smoothing and qc holds the qcRecords; files that
+        fail are dropped from the chunk here, without another read, when --qc-exclude is given.
+    """
+    filenames, args, texts = task
+    if texts == None: texts = [None] * len(filenames)
+    session = Coloration.fromArgs(args)
+    nm = session.nanometers
+    rows = [None] * len(filenames)
+    metadata = [None] * len(filenames)
+    errors = []
+    
+    # LOAD WHAT WE CAN FROM THE CACHE
+    keys = [None] * len(filenames)
+    misses = []
+    with timer.stage('cache load', len(filenames)):
+        for count, filename in enumerate(filenames):
+            if args.cache_dir != None:
+                try: keys[count] = cacheKey(filename, args)
+                except OSError: pass
+            if keys[count] != None:
+                rows[count] = loadCached(args.cache_dir, keys[count])
+                if rows[count] is not None and rows[count].shape == nm.shape:
+                    continue
+                rows[count] = None
+            misses.append(count)
+    
+    # READ AND INTERPOLATE THE REST
+    spectra = []
+    read = []
+    with timer.stage('parse'):
+        for count in misses:
+            filename, result, error = readFile((filenames[count], args, texts[count]))
+            if error != None:
+                errors.append((filename, error))
+                continue
+            nanometers, reflectances, header, metadata[count] = result
+            spectra.append((nanometers, reflectances))
+            read.append(count)
+    
+    with timer.stage('interpolate', len(spectra)):
+        resampled, failures = session.resample(spectra)
+        for index, error in failures:
+            errors.append((filenames[read[index]], error))
     
-    s = "Value,"+','.join(itertools.chain(column_names))
-    print s
-    for count, line in enumerate(data_set):
-        print row_names[count] + ',' + ','.join(["%.3f" % f for f in line])
+    with timer.stage('cache store', len(read)):
+        for count, reflectances in zip(read, resampled):
+            rows[count] = reflectances
+            if keys[count] != None and reflectances is not None:
+                storeCached(args.cache_dir, keys[count], reflectances, args.cache_size * 2**20)
     
-    # data_set = np.transpose(data_set)
-    # np.savetxt(fout, data_set, delimiter=',', fmt='%1.4f')   # X is an array
+    kept = [count for count in range(len(filenames)) if rows[count] is not None]
+    if args.metadata != None:
+        for count in kept:
+            if metadata[count] == None: metadata[count] = readMetadata(filenames[count], args.format)
+    
+    header_list = [os.path.basename(filenames[count]) for count in kept]
+    metadata = [metadata[count] for count in kept]
+    rows = np.array([rows[count] for count in kept])
+    screening = args.qc != None or args.qc_exclude
+    if screening:
+        with timer.stage('screen', len(rows)):
+            flags = screenSpectra(nm, rows, None, args.spike_threshold, args.saturation)
+    if args.smooth and len(rows) > 0:
+        with timer.stage('smooth', len(rows)):
+            rows = session.smoothRows(rows)
+    
+    qc = []
+    if screening:
+        with timer.stage('screen'):
+            # NaN/Inf COLORS, E.G. A HUE FROM arccos OF 0/0, ONLY SHOW UP ONCE MEASURED
+            colors = session.measure(SpectrumSet(nm, rows, header_list))
+            flags['nonfinite'] |= ~np.isfinite(colors).all(axis=0)
+            qc, failed = qcRecords(header_list, flags)
+            if args.qc_exclude and failed.any():
+                for count in np.flatnonzero(failed):
+                    errors.append((filenames[kept[count]], 'failed QC: %s' % (qc[count][1]['problems'])))
+                keep = np.flatnonzero(~failed)
+                rows = rows[keep]
+                header_list = [header_list[count] for count in keep]
+                metadata = [metadata[count] for count in keep]
+    return (nm, rows, header_list, errors, metadata, qc)
+
+def processChunkTimed(task):
+    """Run processChunk in a worker process and return (result, the worker's stage timings)"""
+    timer.reset()
+    result = processChunk(task)
+    return (result, timer.stages)
+
+def iterChunks(filenames, args, chunk_size):
+    """ Yield processChunk results for consecutive chunk_size slices of filenames, in order.
+        With args.jobs > 1 the chunks run in a process pool with at most two chunks per
+        worker in flight, so memory stays bounded however many files there are.
+    """
+    chunk_size = max(1, chunk_size)
+    if args.read_ahead > 0:
+        texts = readAhead(filenames, args, args.read_ahead)
+        tasks = ((filenames[i:i+chunk_size], args, list(itertools.islice(texts, chunk_size))) \
+                 for i in xrange(0, len(filenames), chunk_size))
+    else:
+        tasks = ((filenames[i:i+chunk_size], args, None) for i in xrange(0, len(filenames), chunk_size))
+    if args.jobs > 1 and len(filenames) > chunk_size:
+        pool = multiprocessing.Pool(args.jobs)
+        pending = collections.deque()
+        try:
+            for task in tasks:
+                pending.append(pool.apply_async(processChunkTimed, (task,)))
+                if len(pending) >= args.jobs * 2:
+                    # get() WITH A TIMEOUT KEEPS CONTROL-C WORKING IN THE PARENT
+                    result, stages = pending.popleft().get(sys.maxint)
+                    timer.merge(stages)
+                    yield result
+            while pending:
+                result, stages = pending.popleft().get(sys.maxint)
+                timer.merge(stages)
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for task in tasks:
+            yield processChunk(task)
+
+def defaultChunkSize(numb_files, args):
+    """ Chunk size for numb_files files when --chunk-size is not given: four chunks per worker,
+        and no more than four read-ahead windows so reading overlaps processing
+    """
+    chunk_size = numb_files
+    if args.jobs > 1:
+        chunk_size = -(-numb_files // (args.jobs * 4))
+    if args.read_ahead > 0:
+        chunk_size = min(chunk_size, args.read_ahead * 4)
+    return max(1, chunk_size)
+
+def reportErrors(errors):
+    """Write the (filename, error) pairs from processChunk to STDERR"""
+    for filename, error in errors:
+        sys.stderr.write('Skipping %s (%s)\n' % (filename, error))
+
+def processFiles(filenames, args, metadata=None, stats=None, qc=None):
+    """ Run processChunk over filenames, spread across args.jobs worker processes, and
+        return (spectra, header_list) in the same order as filenames, where spectra is a
+        SpectrumSet with room for every file allocated when the first chunk arrives. Files
+        that fail are reported to STDERR and left out. The metadata of every kept file is
+        appended to the metadata list, the screening report of every file to the qc list and
+        each chunk folded into the GroupedStats if they are given.
+    """
+    chunk_size = defaultChunkSize(len(filenames), args)
+    spectra = None
+    for nm, rows, headers, errors, chunk_metadata, chunk_qc in iterChunks(filenames, args, chunk_size):
+        reportErrors(errors)
+        if metadata != None: metadata.extend(chunk_metadata)
+        if qc != None: qc.extend(chunk_qc)
+        if len(headers) == 0: continue
+        if spectra == None:
+            spectra = SpectrumSet(nm, capacity=len(filenames))
+        spectra.append(rows, headers)
+        if stats != None:
+            with timer.stage('stats', len(headers)):
+                stats.update(SpectrumSet(nm, rows, headers), headers)
+    if spectra == None:
+        spectra = SpectrumSet(np.array([]))
+    return (spectra, spectra.names)
 
-def saveCSV(data_set, column_names, fout):
-    """Save files as table"""
+# MOST PARTIAL CSV FILES mergeCSVColumns KEEPS OPEN AT ONCE
+MAX_OPEN_FILES = 256
+
+def mergeCSVColumns(part_files, fout, header=None):
+    """ Paste the columns of several CSV files side by side into fout, one line at a time,
+        optionally writing a header line first. Memory use is one line per file.
+    """
     fout = open(fout,'w')
-    s = 'nanometers,' + ','.join(itertools.chain(column_names)) + '\n'
-    fout.write(s)
-    data_set = np.transpose(data_set)
-    np.savetxt(fout, data_set, delimiter=',', fmt='%1.4f')   # X is an array
+    if header != None:
+        fout.write(header)
+    parts = [open(part,'r') for part in part_files]
+    for lines in itertools.izip(*parts):
+        fout.write(','.join([line.rstrip('\n') for line in lines]) + '\n')
+    for part in parts:
+        part.close()
+    fout.close()
 
-    
-def parseFile(filename, min_reflct, max_reflct, header, intrp):
-    """ Read in ocean optics datafile (with headers) and return array of reflectance measurments
-        The user can provide min and max reflectance values (e.g., 300-700)
+def streamFiles(filenames, args, metadata=None, stats=None, qc=None):
+    """ Process filenames args.chunk_size at a time, writing each chunk's columns to disk and
+        computing its color measurments before the next chunk is read. The merged CSV is
+        identical to saveCSV output and binary output grows one chunk at a time.
+        Returns (header_list, color_measurments), appends the metadata of every kept file to the
+        metadata list and the screening report of every file to the qc list, and folds each
+        chunk into the GroupedStats if they are given.
     """
-    min_reflct = float(min_reflct)
-    max_reflct = float(max_reflct) + 1.0
+    session = Coloration.fromArgs(args)
+    write_csv = args.output_format in ['csv', 'both']
+    write_binary = args.output_format in ['binary', 'both']
+    temp_dir = tempfile.mkdtemp(prefix='spec_', dir=os.path.dirname(os.path.abspath(args.output_file)))
+    try:
+        part_files = []
+        header_list = []
+        colors = []
+        for nm, rows, headers, errors, chunk_metadata, chunk_qc in iterChunks(filenames, args, args.chunk_size):
+            reportErrors(errors)
+            if metadata != None: metadata.extend(chunk_metadata)
+            if qc != None: qc.extend(chunk_qc)
+            if len(headers) == 0: continue
+            chunk = SpectrumSet(nm, rows, headers)
+            with timer.stage('save', len(headers)):
+                if write_csv:
+                    if len(part_files) == 0:
+                        part_files.append(os.path.join(temp_dir, 'nanometers.csv'))
+                        np.savetxt(part_files[-1], nm[:,np.newaxis], delimiter=',', fmt='%1.4f')
+                    part_files.append(os.path.join(temp_dir, 'part%06d.csv' % len(part_files)))
+                    np.savetxt(part_files[-1], np.transpose(rows), delimiter=',', fmt='%1.4f')
+                if write_binary:
+                    if len(header_list) == 0 and not args.append:
+                        saveBinary(chunk, headers, args.output_file, args.output_dtype)
+                    else:
+                        appendBinary(chunk, headers, args.output_file)
+            with timer.stage('colors', len(headers)):
+                colors.append(session.measure(chunk))
+            if stats != None:
+                with timer.stage('stats', len(headers)):
+                    stats.update(chunk, headers)
+            header_list.extend(headers)
+        
+        if len(header_list) == 0:
+            return (header_list, None)
         
-    in_data_flag = False
+        if write_csv:
+            # MERGE IN ROUNDS SO NO MORE THAN MAX_OPEN_FILES ARE OPEN TOGETHER
+            rounds = 0
+            while len(part_files) > MAX_OPEN_FILES:
+                rounds += 1
+                merged = []
+                for i in range(0, len(part_files), MAX_OPEN_FILES):
+                    merged.append(os.path.join(temp_dir, 'merge%02d_%06d.csv' % (rounds, len(merged))))
+                    mergeCSVColumns(part_files[i:i+MAX_OPEN_FILES], merged[-1])
+                part_files = merged
+            header = 'nanometers,' + ','.join(itertools.chain(header_list)) + '\n'
+            with timer.stage('save'):
+                mergeCSVColumns(part_files, args.output_file, header)
+        return (header_list, np.concatenate(colors, axis=1))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
-    fin = open(filename,'r')
-    reflectances = []
-    nanometers = []
-    
-    if header == True:
-        for count, line in enumerate(fin):
+def fileSignature(filename):
+    """Return the (modification time, size) of filename used to notice changed files"""
+    stat = os.stat(filename)
+    return (stat.st_mtime, stat.st_size)
 
-            if "End" in line: break
+def saveCSVColumns(nm_column, columns, column_names, fout):
+    """ Save preformatted '%1.4f' columns as the same table saveCSV writes, so an update only
+        has to format the spectra that changed.
+    """
+    fout = open(fout,'w')
+    fout.write('nanometers,' + ','.join(itertools.chain(column_names)) + '\n')
+    for count, nm in enumerate(nm_column):
+        fout.write(','.join([nm] + [column[count] for column in columns]) + '\n')
+    fout.close()
 
-            if in_data_flag == True:
-                line_parts = line.strip().split()
-                if float(line_parts[0]) >= min_reflct:
-                    nanometers.append(float(line_parts[0]))
-                    reflectances.append(float(line_parts[1]))
-                if float(line_parts[0]) > max_reflct: break
-                
-            if "Begin" in line: 
-                in_data_flag = True
-    
-    else:
-        for count, line in enumerate(fin):
-            line_parts = line.strip().split()
-            if float(line_parts[0]) >= min_reflct:
-                nanometers.append(float(line_parts[0]))
-                reflectances.append(float(line_parts[1]))
-            if float(line_parts[0]) > max_reflct: break
+def watchDirectory(args):
+    """ Process args.input_dir and then poll it every args.watch seconds. Only files that are
+        new or whose modification time or size changed are parsed, interpolated and measured;
+        the merged output, the color tables (written next to the output as .colors.csv) and
+        the --metadata, --qc and --stats files are rebuilt from the per-file results kept in
+        memory. Once no file is left the output, color tables and --stats are removed.
+    """
+    session = Coloration.fromArgs(args)
+    color_file = os.path.splitext(args.output_file)[0] + '.colors.csv'
+    # FILENAME -> (SIGNATURE, REFLECTANCES, CSV COLUMN, COLORS, METADATA, QC RECORD); A FILE THAT
+    # FAILED HAS None FOR ITS RESULTS AND A QC RECORD ONLY IF IT WAS SCREENED OUT BY --qc-exclude
+    known = {}
+    nm = None
+    nm_column = None
+    while True:
+        start = time.time()
+        filenames = getFilenames(args.input_dir)
+        signatures = {}
+        for filename in filenames:
+            try: signatures[filename] = fileSignature(filename)
+            except OSError: pass
+        filenames = [filename for filename in filenames if filename in signatures]
+        changed = [filename for filename in filenames \
+                       if filename not in known or known[filename][0] != signatures[filename]]
+        removed = [filename for filename in known if filename not in signatures]
+        
+        if len(changed) > 0 or len(removed) > 0:
+            for filename in removed:
+                del known[filename]
+            for filename in changed:
+                known[filename] = (signatures[filename], None, None, None, None, None)
             
-    basename = os.path.basename(filename)     
-    reflectances = np.array(reflectances)
-    nanometers = np.array(nanometers)
-    
-    # INTERPOLATE VALUES TO 1 NM INCREMENTS
-    tck = interpolate.splrep(nanometers,reflectances,xb=min_reflct,s=0)
-    nanometers = np.arange(min_reflct,max_reflct,intrp)
-    reflectances = interpolate.splev(nanometers,tck,der=0)
-    return (np.array(reflectances), np.array(nanometers), basename)
-
-def plotMean(data_set):
-    mean = data_set[1:].mean(axis=0)
-    x = data_set.transpose()[:,0]
-    mean = data_set[1:].mean(axis=0)
-    var = data_set[1:].var(axis=0)
-    upper_var = mean + var
-    lower_var = mean - var
-    xlabel('Nanometers')
-    ylabel('Reflectance')
-    maxy = mean.max() + 3
-    ylim(0, maxy)
-    xlim(data_set.transpose()[:,0].min(), data_set.transpose()[:,0].max())
-    fill_between(x, upper_var, lower_var, alpha=0.15, color='k')
-    plot(x,mean,'k')
-
-def plotThumbs(data_set, header_list):
-    data_set = data_set.transpose()
-    numb_cols = data_set.shape[1]
-    cols = int(sqrt(numb_cols))
-    rows = cols + 1
-    x = data_set[:,0]
-    plt.figure()
-    counter = 0
-    
-    for r in arange(0,rows):
-        for c in arange(0,cols):
-            if counter == data_set.shape[1]-1: break
+            # ONLY THE NEW AND CHANGED FILES GO THROUGH THE PIPELINE
+            by_basename = dict([(os.path.basename(filename), filename) for filename in changed])
+            chunk_size = defaultChunkSize(len(changed), args)
+            for chunk_nm, rows, headers, errors, chunk_metadata, chunk_qc in iterChunks(changed, args, chunk_size):
+                reportErrors(errors)
+                for header, fields in chunk_qc:
+                    filename = by_basename[header]
+                    known[filename] = known[filename][:5] + ((header, fields),)
+                if len(headers) == 0: continue
+                nm = chunk_nm
+                if nm_column == None: nm_column = ['%1.4f' % value for value in nm]
+                colors = session.measure(SpectrumSet(nm, rows, headers))
+                for count, header in enumerate(headers):
+                    filename = by_basename[header]
+                    column = ['%1.4f' % value for value in rows[count]]
+                    known[filename] = (signatures[filename], rows[count], column, colors[:,count], \
+                                       chunk_metadata[count], known[filename][5])
             
-            ax = plt.subplot2grid((rows,cols),(r,c))
-            y = data_set[:,counter+1]
-            ax.annotate(header_list[counter], xy=(.5, .5),  xycoords='axes fraction',
-                            horizontalalignment='center', verticalalignment='center')
-            ax.set_ylim(0, 50)
-            plt.plot(x,y)
-            counter += 1
-
-
-def process_dewlap_dorsal_ventral():
+            # REBUILD THE OUTPUT FROM THE KEPT RESULTS IN getFilenames ORDER
+            kept = [filename for filename in filenames if known[filename][1] is not None]
+            header_list = [os.path.basename(filename) for filename in kept]
+            if len(kept) > 0:
+                if args.output_format in ['csv', 'both']:
+                    saveCSVColumns(nm_column, [known[filename][2] for filename in kept], header_list, args.output_file)
+                if args.output_format in ['binary', 'both'] or args.stats != None:
+                    spectra = SpectrumSet(nm, capacity=len(kept))
+                    for filename, header in zip(kept, header_list):
+                        spectra.append(known[filename][1], [header])
+                if args.output_format in ['binary', 'both']:
+                    saveBinary(spectra, header_list, args.output_file, args.output_dtype)
+                if args.stats != None:
+                    stats = GroupedStats(statsKey(args))
+                    stats.update(spectra, header_list)
+                    saveStats(stats, args.stats, args.confidence)
+                fout = open(color_file,'w')
+                session.printColors(np.column_stack([known[filename][3] for filename in kept]), header_list, fout)
+                fout.close()
+            else:
+                # NO FILE IS LEFT, SO REMOVE THE OUTPUT STILL LISTING THE OLD ONES
+                stale = [color_file]
+                if args.output_format in ['csv', 'both']: stale.append(args.output_file)
+                if args.output_format in ['binary', 'both']: stale.extend(binaryPaths(args.output_file))
+                if args.stats != None: stale.append(args.stats)
+                for path in stale:
+                    if os.path.exists(path): os.remove(path)
+            if args.metadata != None:
+                saveMetadata(header_list, [known[filename][4] for filename in kept], args.metadata)
+            if args.qc != None:
+                saveQC([known[filename][5] for filename in filenames if known[filename][5] != None], args.qc)
+            if args.cache_dir != None:
+                pruneCache(args.cache_dir, args.cache_size * 2**20)
+            print '%s: updated %s new or changed and %s removed files (%s total) in %.1f ms' % \
+                (time.strftime('%H:%M:%S'), len(changed), len(removed), len(kept), (time.time() - start) * 1000)
+            sys.stdout.flush()
+        
+        time.sleep(args.watch)
 
-    args = get_args()
-    filenames = getFilenames(args.input_dir)
-    base_dir_name = os.path.split(args.input_dir)[-1]
+def exportThumbs(data_set, header_list, fout, per_page=100, ylim=(0, 50), dpi=100):
+    """ Draw every spectrum as a labelled thumbnail on paged grids and save the pages without
+        a display. Each page is a single axes holding one LineCollection of all its spectra,
+        instead of one subplot per spectrum. A .pdf fout is written as one multi-page file;
+        otherwise pages go to fout, or fout_001.png, fout_002.png, ... when there are several.
+        Returns the list of files written.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.backends.backend_pdf import PdfPages
+    from matplotlib.collections import LineCollection
     
-    # SETUP DATASET
-    col_headers = []
-    data_set = []
-    header_list = []
+    x, spectra = spectrumArrays(data_set)
+    per_page = max(1, min(per_page, len(spectra)))
+    cols = int(np.ceil(np.sqrt(per_page)))
+    rows = int(np.ceil(per_page / float(cols)))
     
-    # Sort files by tissue allowing for missspellings
-    organized_by_tissue = {'dewlap':[], 'dorsal':[], 'ventral':[]}
-    for count, filename in enumerate(filenames):
-
-        fname = os.path.split(filename)[-1]
+    # POSITIONS INSIDE A UNIT CELL, LEAVING ROOM FOR THE LABEL AT THE TOP
+    pad, label_space = 0.05, 0.2
+    cell_x = (x - x.min()) / float(x.max() - x.min() or 1) * (1 - 2*pad) + pad
+    cell_y = (np.clip(spectra, ylim[0], ylim[1]) - ylim[0]) / float(ylim[1] - ylim[0]) * \
+             (1 - 2*pad - label_space) + pad
+    frame = np.array([[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]], dtype=float)
+    
+    root, extension = os.path.splitext(fout)
+    numb_pages = int(np.ceil(len(spectra) / float(per_page)))
+    pdf = None
+    if extension.lower() == '.pdf': pdf = PdfPages(fout)
+    written = []
+    for page in range(numb_pages):
+        start = page * per_page
+        count = min(per_page, len(spectra) - start)
+        col = np.arange(count) % cols
+        row = rows - 1 - np.arange(count) // cols
         
-        for tissue in organized_by_tissue.keys():
-           distances = sort([jellyfish.hamming_distance(tissue, item) for item in fname.split("_")])
-           if distances[0] <= 2:
-                organized_by_tissue[tissue].append(filename)
-
+        # ONE (count x wavelengths x 2) ARRAY OF LINE VERTICES PER PAGE
+        lines = np.empty((count, x.size, 2))
+        lines[:,:,0] = cell_x + col[:,np.newaxis]
+        lines[:,:,1] = cell_y[start:start+count] + row[:,np.newaxis]
+        frames = frame[np.newaxis,:,:] + np.column_stack((col, row))[:,np.newaxis,:]
+        
+        fig = Figure(figsize=(cols * 1.6, rows * 1.2))
+        canvas = FigureCanvasAgg(fig)
+        ax = fig.add_axes([0, 0, 1, 1])
+        ax.set_xlim(0, cols)
+        ax.set_ylim(0, rows)
+        ax.set_axis_off()
+        ax.add_collection(LineCollection(frames, colors='0.7', linewidths=0.5))
+        ax.add_collection(LineCollection(lines, colors='k', linewidths=0.6))
+        for i in range(count):
+            ax.text(col[i] + 0.5, row[i] + 1 - pad, header_list[start + i], fontsize=6,
+                    horizontalalignment='center', verticalalignment='top', clip_on=True)
+        
+        if pdf != None:
+            pdf.savefig(fig)
+        else:
+            if numb_pages == 1: path = fout
+            else: path = '%s_%03d%s' % (root, page + 1, extension)
+            canvas.print_figure(path, dpi=dpi)
+            written.append(path)
     
-    print organized_by_tissue
+    if pdf != None:
+        pdf.close()
+        written.append(fout)
+    return written
 
+# TISSUE LABELS RECOGNIZED IN FILENAMES BY process_dewlap_dorsal_ventral
+TISSUES = ('dewlap', 'dorsal', 'ventral')
 
+# MOST MISMATCHED LETTERS ALLOWED BETWEEN A FILENAME TOKEN AND A TISSUE
+MAX_TISSUE_DISTANCE = 2
 
-    #     reflectances, nm, header = parseFile(filename, args.min_nm, args.max_nm, args.header, args.intrp)
-    #     if args.smooth:
-    #         reflectances = smooth(reflectances, args.window_length, args.window_type,)            
-    #     if count == 0:
-    #         data_set.append(nm)
-    #     header_list.append(header)
-    #     data_set.append(reflectances)
-    # data_set = np.array(data_set)
-    # # DO #$%^ WITH THE DATA!!!!
-    # if args.plot == True: 
-    #     plotMean(data_set) 
-    #     plotThumbs(data)
-       
-def main():
+# (TISSUES, MAX DISTANCE) -> (SHORTEST, LONGEST, {TOKEN: (DISTANCE, RANK, TISSUE)}, {FILENAME: TISSUE})
+# SO TISSUE KEYS ARE PREPARED ONCE AND REPEATED TOKENS AND FILENAMES ARE MATCHED ONCE
+_tissue_keys = {}
 
-    args = get_args()
+# MOST TOKENS OR FILENAMES KEPT IN EACH MATCH CACHE BEFORE IT IS EMPTIED
+TISSUE_CACHE_SIZE = 200000
+
+def boundedHamming(a, b, bound):
+    """ Hamming distance between a and b, counting any difference in length as mismatches
+        (as jellyfish.hamming_distance does), but giving up with bound + 1 as soon as the
+        distance is known to exceed bound.
+    """
+    distance = abs(len(a) - len(b))
+    if distance > bound: return bound + 1
+    for x, y in itertools.izip(a, b):
+        if x != y:
+            distance += 1
+            if distance > bound: return bound + 1
+    return distance
+
+def tissueKeys(tissues=TISSUES, max_distance=MAX_TISSUE_DISTANCE):
+    """ Return (shortest, longest, tokens, names) for tissues: the range of token lengths that
+        can be within max_distance of any tissue and the caches of tokens and filenames matched
+        so far.
+    """
+    key = (tissues, max_distance)
+    if key not in _tissue_keys:
+        lengths = [len(tissue) for tissue in tissues]
+        _tissue_keys[key] = (min(lengths) - max_distance, max(lengths) + max_distance, {}, {})
+    return _tissue_keys[key]
+
+def matchToken(token, tissues=TISSUES, max_distance=MAX_TISSUE_DISTANCE):
+    """ Return (distance, rank, tissue) of the closest tissue to token, or to token without its
+        trailing digits (e.g. dorsal011), where rank is the tissue's position in tissues, or
+        (max_distance + 1, len(tissues), None).
+    """
+    shortest, longest, tokens, names = tissueKeys(tissues, max_distance)
+    if token not in tokens:
+        best = (max_distance + 1, len(tissues), None)
+        for candidate in set([token, token.rstrip('0123456789')]):
+            # TOKENS TOO SHORT OR LONG FOR ANY TISSUE NEED NO COMPARISON
+            if not shortest <= len(candidate) <= longest: continue
+            match = (max_distance + 1, len(tissues), None)
+            for rank, tissue in enumerate(tissues):
+                # ONLY A STRICTLY CLOSER TISSUE CAN REPLACE THE CURRENT BEST
+                distance = boundedHamming(candidate, tissue, match[0] - 1)
+                if distance < match[0]:
+                    match = (distance, rank, tissue)
+                    if distance == 0: break
+            if match < best: best = match
+        if len(tokens) >= TISSUE_CACHE_SIZE: tokens.clear()
+        tokens[token] = best
+    return tokens[token]
+
+def classifyTissue(filename, tissues=TISSUES, max_distance=MAX_TISSUE_DISTANCE):
+    """ Return the single tissue that best matches filename, allowing for misspellings, or None.
+        The name (without extension, lower case) is split on underscores and each token, with
+        and without trailing digits (e.g. dorsal011), is compared to every tissue. The smallest
+        distance wins and ties go to the tissue listed first.
+    """
+    shortest, longest, tokens, names = tissueKeys(tissues, max_distance)
+    tissue = names.get(filename, False)
+    if tissue is False:
+        # os.path.splitext(os.path.basename(filename))[0] WITHOUT THE FUNCTION CALLS
+        name = filename[max(filename.rfind(os.sep), filename.rfind(os.altsep or os.sep)) + 1:]
+        dot = name.rfind('.')
+        if dot > len(name) - len(name.lstrip('.')): name = name[:dot]
+        best = (max_distance + 1, len(tissues), None)
+        for token in name.lower().split('_'):
+            match = tokens.get(token) or matchToken(token, tissues, max_distance)
+            if match < best: best = match
+        tissue = best[2]
+        if len(names) >= TISSUE_CACHE_SIZE: names.clear()
+        names[filename] = tissue
+    return tissue
+
+def statsKey(args):
+    """Return the function that groups sample names for --stats-by, or None for one group"""
+    return {'all': None, 'prefix': filePrefix, 'tissue': classifyTissue}[args.stats_by]
+
+def process_dewlap_dorsal_ventral(args):
+    """ Sort the input files by tissue, process them in one pass and run the rest of the
+        pipeline on each tissue's view of the spectra, writing one output per tissue (e.g.
+        out_dorsal.csv) and printing its color tables.
+    """
+    session = Coloration.fromArgs(args)
+    filenames = getFilenames(args.input_dir)
+    metadata = []
+    
+    # Sort files by tissue allowing for missspellings
+    organized_by_tissue = dict([(tissue, []) for tissue in TISSUES])
+    labels = {} # SAMPLE NAME -> TISSUE, SO THE GROUPING BELOW DOES NOT MATCH NAMES AGAIN
+    for filename in filenames:
+        tissue = classifyTissue(filename)
+        if tissue == None:
+            sys.stderr.write('Skipping %s (no dewlap, dorsal or ventral in filename)\n' % (filename))
+            continue
+        organized_by_tissue[tissue].append(filename)
+        labels[os.path.basename(filename)] = tissue
+    
+    # FILES ARE PROCESSED IN TISSUE ORDER SO EACH TISSUE IS ONE RUN OF ROWS
+    filenames = list(itertools.chain(*[organized_by_tissue[tissue] for tissue in TISSUES]))
+    stats = None
+    if args.stats != None:
+        if args.stats_by == 'tissue': stats = GroupedStats(labels.get)
+        else: stats = GroupedStats(statsKey(args))
+    qc = []
+    spectra, metadata_names = processFiles(filenames, args, metadata, stats, qc)
+    by_tissue = spectra.groupBy(labels.get)
+    
+    root, extension = os.path.splitext(args.output_file)
+    for tissue in TISSUES:
+        if tissue not in by_tissue: continue
+        data_set = by_tissue[tissue]
+        header_list = data_set.names
+        
+        tissue_args = argparse.Namespace(**vars(args))
+        tissue_args.output_file = '%s_%s%s' % (root, tissue, extension)
+        
+        # DO #$%^ WITH THE DATA!!!!
+        if args.thumbs != None:
+            root_thumbs, extension_thumbs = os.path.splitext(args.thumbs)
+            exportThumbs(data_set, header_list, '%s_%s%s' % (root_thumbs, tissue, extension_thumbs), \
+                         args.thumbs_per_page)
+        
+        if args.plot == True: 
+            import matplotlib.pyplot as plt
+            # EACH TISSUE GETS ITS OWN MEAN FIGURE; plotThumbs OPENS ANOTHER
+            plt.figure()
+            plotMean(data_set, args.plot_band, args.confidence) 
+            plt.title(tissue)
+            plotThumbs(data_set,header_list)
+        
+        saveOutput(data_set, header_list, tissue_args)
+        print '%s (%s files)' % (tissue.capitalize(), len(header_list))
+        session.printColors(session.measure(data_set), header_list)
+        print
+    
+    if args.metadata != None:
+        saveMetadata(metadata_names, metadata, args.metadata)
+    if stats != None and len(stats.groups) > 0:
+        saveStats(stats, args.stats, args.confidence)
+    if args.qc != None:
+        saveQC(qc, args.qc)
+    
+    if args.plot == True:
+        import matplotlib.pyplot as plt
+        plt.show()
+       
+def run(args):
+    """Run the pipeline selected by args"""
+    # CHECK THE SCHEMES AND REFERENCE FILES BEFORE ANY WORK IS DONE
+    try:
+        Coloration.fromArgs(args)
+        if not 0 < args.confidence < 1:
+            raise ValueError, "--confidence must be between 0 and 1."
+    except (IOError, OSError, ValueError), e:
+        sys.stderr.write('%s\n' % (e))
+        sys.exit(1)
     
     if args.DDV == True: 
-        process_dewlap_dorsal_ventral()
+        process_dewlap_dorsal_ventral(args)
+    
+    elif args.watch != None:
+        watchDirectory(args)
     
     else:
+        session = Coloration.fromArgs(args)
         filenames = getFilenames(args.input_dir)
         base_dir_name = os.path.split(args.input_dir)[-1]
+        metadata = []
+        stats = None
+        if args.stats != None: stats = GroupedStats(statsKey(args))
+        qc = []
         
-        # SETUP DATASET
-        col_headers = []
-        data_set = []
-        header_list = []
-        for count, filename in enumerate(filenames):
-            reflectances, nm, header = parseFile(filename, args.min_nm, args.max_nm, args.header, args.intrp)
-            if args.smooth:
-                reflectances = smooth(reflectances, args.window_length, args.window_type,)            
-            if count == 0:
-                data_set.append(nm)
-            header_list.append(header)
-            data_set.append(reflectances)
-        data_set = np.array(data_set)
+        # STREAM LARGE DIRECTORIES CHUNK BY CHUNK
+        if args.chunk_size > 0:
+            if args.plot == True or args.thumbs != None:
+                sys.stderr.write('Plotting needs every spectrum in memory and is skipped with --chunk-size.\n')
+            header_list, colors = streamFiles(filenames, args, metadata, stats, qc)
+            data_set = None
+        
+        else:
+            # SETUP DATASET
+            data_set, header_list = processFiles(filenames, args, metadata, stats, qc)
+        
+        if args.qc != None:
+            saveQC(qc, args.qc)
+        if len(header_list) == 0:
+            print 'No spec files could be processed in %s.' % (args.input_dir)
+            sys.exit(1)
         
         # DO #$%^ WITH THE DATA!!!!
-        if args.plot == True: 
-            plotMean(data_set) 
-            plotThumbs(data_set,header_list)
-            plt.show()
-            plt.savefig('test.png')
+        if args.chunk_size <= 0:
+            with timer.stage('plot', len(header_list)):
+                if args.thumbs != None:
+                    exportThumbs(data_set, header_list, args.thumbs, args.thumbs_per_page)
+                
+                if args.plot == True: 
+                    import matplotlib.pyplot as plt
+                    plotMean(data_set, args.plot_band, args.confidence) 
+                    plotThumbs(data_set,header_list)
+                    plt.show()
 
-        saveCSV(data_set, header_list, args.output_file)
-        macedonia, endler = calcColorMeasurments(data_set)
-        row_names = ['U (325-399nm)', 'B (40-474nm)', 'G (475-549nm)', 'Y (550-624)',\
-                     'R (625-700)', 'Qt','MU', 'MS', 'LM', 'C', 'H']
-        
-        print 'Macedonia Values' 
-        printCSV(macedonia, header_list, row_names)
+            with timer.stage('save', len(header_list)):
+                saveOutput(data_set, header_list, args)
+            with timer.stage('colors', len(header_list)):
+                colors = session.measure(data_set)
         
-        print '\n' +'Endler Values'
-        printCSV(endler, header_list, row_names)
+        if args.metadata != None:
+            saveMetadata(header_list, metadata, args.metadata)
+        if stats != None:
+            with timer.stage('save'):
+                saveStats(stats, args.stats, args.confidence)
+        if args.cache_dir != None:
+            with timer.stage('cache prune'):
+                pruneCache(args.cache_dir, args.cache_size * 2**20)
+        session.printColors(colors, header_list)
         return data_set
 
+def main():
+
+    args = get_args()
+    if args.verbose or args.timing_json != None:
+        timer.enable()
+    
+    profile = None
+    if args.profile != None:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+    
+    try:
+        return run(args)
+    finally:
+        if profile != None:
+            profile.disable()
+            profile.dump_stats(args.profile)
+        if args.verbose:
+            timer.report()
+            if profile != None:
+                import pstats
+                pstats.Stats(profile, stream=sys.stderr).sort_stats('cumulative').print_stats(20)
+        if args.timing_json != None:
+            fout = open(args.timing_json,'w')
+            json.dump(timer.results(), fout, indent=1)
+            fout.close()
+
 
 if __name__ == '__main__':
 
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_colors.py
+
+Checks that calcColorMeasurments gives the same values as the original per-author
+implementation on the bundled test spectra.
+
+python -m unittest test_colors
+
+"""
+
+import os
+import unittest
+import numpy as np
+
+from Coloration import Coloration, calcColorMeasurments
+
+TEST_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data')
+
+def legacy_calcColorMeasurments(data_array):
+    """Per-author mask and compress loop used before the band-index engine"""
+    Macedonia_values = []
+    Endler_values = []
+    data_array = data_array.transpose()
+    for author in ['Macedonia', 'Endler']:
+        if author == 'Macedonia': Qt = (data_array[:,0] >= 325) & (data_array[:,0] <= 700)
+        else: Qt = (data_array[:,0] >= 400) & (data_array[:,0] <= 700)
+        U = (data_array[:,0] >= 325) & (data_array[:,0] < 400)
+        B = (data_array[:,0] >= 400) & (data_array[:,0] < 475)
+        G = (data_array[:,0] >= 475) & (data_array[:,0] < 550)
+        Y = (data_array[:,0] >= 550) & (data_array[:,0] < 625)
+        R = (data_array[:,0] >= 625) & (data_array[:,0] <= 700)
+        B = data_array[:,1:].compress(B,0).sum(0) / data_array[:,1:].compress(Qt,0).sum(0)
+        G = data_array[:,1:].compress(G,0).sum(0) / data_array[:,1:].compress(Qt,0).sum(0)
+        Y = data_array[:,1:].compress(Y,0).sum(0) / data_array[:,1:].compress(Qt,0).sum(0)
+        R = data_array[:,1:].compress(R,0).sum(0) / data_array[:,1:].compress(Qt,0).sum(0)
+        if author == 'Macedonia': U = data_array[:,1:].compress(U,0).sum(0) / data_array[:,1:].compress(Qt,0).sum(0)
+        else: U = np.zeros(data_array[:,1:].shape[-1])
+        Qt = data_array[:,1:].compress(Qt,0).sum(0)
+        if author == 'Macedonia': MU = G-U
+        else: MU = np.zeros(data_array[:,1:].shape[-1])
+        MS = Y-B
+        LM = R-G
+        if author == 'Macedonia': C = np.sqrt(pow(LM,2)+pow(MS,2)+pow(MU,2))
+        else: C = np.sqrt(pow(LM,2)+pow(MS,2))
+        H = np.degrees(np.arccos(LM/C))
+        if author == 'Macedonia': Macedonia_values = [U,B,G,Y,R,Qt,MU,MS,LM,C,H]
+        else: Endler_values = [U,B,G,Y,R,Qt,MU,MS,LM,C,H]
+    return np.array([Macedonia_values, Endler_values])
+
+class TestColorMeasurments(unittest.TestCase):
+
+    def checkGrid(self, min_nm, max_nm, intrp):
+        session = Coloration(min_nm, max_nm, intrp, header=True)
+        filenames = session.getFilenames(os.path.join(TEST_DATA, 'testfiles_with_headers'))
+        spectra, header_list, errors = session.processFiles(filenames)
+        self.assertEqual(errors, [])
+        data_set = spectra.dataSet()
+        old = legacy_calcColorMeasurments(data_set)
+        new = calcColorMeasurments(data_set)
+        self.assertEqual(old.shape, new.shape)
+        self.assertTrue(np.allclose(old, new, rtol=1e-12, atol=0, equal_nan=True))
+        # THE PRINTED TABLES ROUND TO 3 PLACES AND MUST NOT CHANGE
+        self.assertTrue(np.array_equal(np.round(old, 3), np.round(new, 3)))
+
+    def test_default_grid(self):
+        self.checkGrid(300, 700, 1.0)
+
+    def test_half_nm_grid(self):
+        self.checkGrid(320, 720, 0.5)
+
+    def test_narrow_grid(self):
+        self.checkGrid(400, 650, 1.0)
+
+if __name__ == '__main__':
+    unittest.main()